@@ -2,98 +2,109 @@
 Модуль для интеграции существующего бота с базой данных админ-панели
 """
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy import select
-from typing import Optional
+from sqlalchemy import select, func, literal, true
+from sqlalchemy.orm import aliased
+from typing import Optional, List, Dict
 import os
 import asyncio
-from datetime import datetime
+import atexit
+import concurrent.futures
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
 
 from .models import Chat, User, Message, ChatSettings, Preset
-from .database import AsyncSessionLocal
+from .database import AsyncSessionLocal, async_engine
+from .write_queue import MessageWriteQueue
+from .identity_cache import IdentityCache
+from .upsert import upsert_chats, upsert_users
+from .services.message_service import MessageService
+from .config_events import preset_event, chat_event
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Сколько чатов и пользователей держать в кэше идентификаторов
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "50000"))
+# Сколько держать пресет по умолчанию в памяти процесса (секунды); изменения сбрасывают его раньше
+DEFAULT_PRESET_TTL = float(os.getenv("DEFAULT_PRESET_TTL", "3600"))
+# Насколько опрос изменений заглядывает назад от отметки: updated_at в SQLite
+# с точностью до секунды, а в PostgreSQL это время начала транзакции, которая
+# может зафиксироваться позже следующего опроса
+CONFIG_POLL_OVERLAP = timedelta(seconds=float(os.getenv("CONFIG_POLL_OVERLAP", "120")))
+
+def message_to_row(message, is_from_bot: bool = False, message_hash: Optional[str] = None) -> dict:
+    """Снимок сообщения Telegram для сохранения в БД (без ссылок на объекты telebot)"""
+    if message_hash is None:
+        message_hash = hashlib.sha256((message.text or "").encode()).hexdigest()[:8]
+    
+    from_user = getattr(message, 'from_user', None)
+    return {
+        "chat": {
+            "telegram_chat_id": message.chat.id,
+            "chat_type": message.chat.type,
+            "title": getattr(message.chat, 'title', None),
+            "username": getattr(message.chat, 'username', None),
+        },
+        "user": {
+            "telegram_user_id": from_user.id,
+            "username": getattr(from_user, 'username', None),
+            "first_name": getattr(from_user, 'first_name', None),
+            "last_name": getattr(from_user, 'last_name', None),
+            "is_bot": True if is_from_bot else getattr(from_user, 'is_bot', False),
+        } if from_user else None,
+        "message": {
+            "telegram_message_id": message.message_id,
+            "content": message.text or "",
+            "message_type": "text",
+            "is_from_bot": is_from_bot,
+            "message_hash": message_hash,
+            # Время постановки в очередь: порядок сообщений не зависит от момента записи
+            "created_at": datetime.now(timezone.utc),
+        },
+    }
+
 class BotDatabaseIntegration:
     def __init__(self):
         self.session = AsyncSessionLocal
+        self.chat_identities = IdentityCache(IDENTITY_CACHE_SIZE)
+        self.user_identities = IdentityCache(IDENTITY_CACHE_SIZE)
+        # Пресет по умолчанию общий для всех чатов — держим один на процесс
+        self._default_preset: Optional[Preset] = None
+        self._default_preset_loaded_at: Optional[float] = None
+        # Растет при каждом сбросе: запрос, начатый до сброса, не кладет в кэш старый пресет
+        self._default_preset_version = 0
     
     async def get_or_create_chat(self, telegram_chat_id: int, chat_type: str = "private", 
                                 title: Optional[str] = None, username: Optional[str] = None) -> Chat:
         """Получить или создать чат в базе данных"""
         async with self.session() as db:
-            # Ищем существующий чат
-            result = await db.execute(
-                select(Chat).filter(Chat.telegram_chat_id == telegram_chat_id)
-            )
-            chat = result.scalar_one_or_none()
-            
-            if not chat:
-                # Создаем новый чат
-                chat = Chat(
-                    telegram_chat_id=telegram_chat_id,
-                    chat_type=chat_type,
-                    title=title,
-                    username=username
-                )
-                db.add(chat)
-                await db.commit()
-                await db.refresh(chat)
-                
-                # Создаем настройки по умолчанию
-                settings = ChatSettings(
-                    chat_id=chat.id,
-                    auto_reply_enabled=True,
-                    reply_on_mention_enabled=True
-                )
-                db.add(settings)
-                await db.commit()
-                
-                logger.info(f"Created new chat: {telegram_chat_id}")
-            
-            return chat
+            # Upsert вместо select-then-insert: нет гонки при одновременном создании чата
+            chat_ids = await upsert_chats(db, [{
+                "telegram_chat_id": telegram_chat_id,
+                "chat_type": chat_type,
+                "title": title,
+                "username": username
+            }])
+            await db.commit()
+            return await db.get(Chat, chat_ids[telegram_chat_id])
     
     async def get_or_create_user(self, telegram_user_id: int, username: Optional[str] = None,
                                first_name: Optional[str] = None, last_name: Optional[str] = None,
                                is_bot: bool = False) -> User:
-        """Получить или создать пользователя в базе данных"""
+        """Получить или создать пользователя в базе данных (профиль обновляется)"""
         async with self.session() as db:
-            # Ищем существующего пользователя
-            result = await db.execute(
-                select(User).filter(User.telegram_user_id == telegram_user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                # Создаем нового пользователя
-                user = User(
-                    telegram_user_id=telegram_user_id,
-                    username=username,
-                    first_name=first_name,
-                    last_name=last_name,
-                    is_bot=is_bot
-                )
-                db.add(user)
-                await db.commit()
-                await db.refresh(user)
-                logger.info(f"Created new user: {telegram_user_id}")
-            else:
-                # Обновляем информацию о пользователе если изменилась
-                updated = False
-                if user.username != username:
-                    user.username = username
-                    updated = True
-                if user.first_name != first_name:
-                    user.first_name = first_name
-                    updated = True
-                if user.last_name != last_name:
-                    user.last_name = last_name
-                    updated = True
-                
-                if updated:
-                    await db.commit()
-            
-            return user
+            user_ids = await upsert_users(db, [{
+                "telegram_user_id": telegram_user_id,
+                "username": username,
+                "first_name": first_name,
+                "last_name": last_name,
+                "is_bot": is_bot
+            }])
+            await db.commit()
+            return await db.get(User, user_ids[telegram_user_id])
     
     async def save_message(self, telegram_message_id: int, chat_id, user_id,
                           content: str, message_type: str = "text", is_from_bot: bool = False,
@@ -116,6 +127,181 @@ class BotDatabaseIntegration:
             logger.info(f"Saved message: {message_hash}")
             return message
     
+    @staticmethod
+    def _chat_fingerprint(data: dict) -> int:
+        return IdentityCache.fingerprint(data["chat_type"], data["title"], data["username"])
+    
+    @staticmethod
+    def _user_fingerprint(data: dict) -> int:
+        return IdentityCache.fingerprint(data["username"], data["first_name"], data["last_name"])
+    
+    async def _resolve_chats(self, db: AsyncSession, chats: List[dict]) -> Dict[int, uuid.UUID]:
+        """Найти или создать чаты пачкой; возвращает telegram_chat_id -> id.
+        
+        Известные чаты с неизменным профилем берутся из кэша, остальные
+        разрешаются одним upsert-запросом.
+        """
+        wanted = {chat["telegram_chat_id"]: chat for chat in chats}
+        resolved = {}
+        for telegram_chat_id, data in wanted.items():
+            chat_id = self.chat_identities.lookup(telegram_chat_id, self._chat_fingerprint(data))
+            if chat_id is not None:
+                resolved[telegram_chat_id] = chat_id
+        
+        missing = [wanted[telegram_chat_id] for telegram_chat_id in wanted if telegram_chat_id not in resolved]
+        if missing:
+            resolved.update(await upsert_chats(db, missing))
+        return resolved
+    
+    async def _resolve_users(self, db: AsyncSession, users: List[dict]) -> Dict[int, uuid.UUID]:
+        """Найти, создать или обновить пользователей пачкой; возвращает telegram_user_id -> id"""
+        wanted = {user["telegram_user_id"]: user for user in users}
+        resolved = {}
+        for telegram_user_id, data in wanted.items():
+            user_id = self.user_identities.lookup(telegram_user_id, self._user_fingerprint(data))
+            if user_id is not None:
+                resolved[telegram_user_id] = user_id
+        
+        missing = [wanted[telegram_user_id] for telegram_user_id in wanted if telegram_user_id not in resolved]
+        if missing:
+            resolved.update(await upsert_users(db, missing))
+        return resolved
+    
+    def _remember_identities(self, rows: List[dict], chat_ids: Dict[int, uuid.UUID],
+                             user_ids: Dict[int, uuid.UUID]):
+        """Запомнить разрешенные идентификаторы — только после успешного коммита"""
+        for row in rows:
+            chat = row["chat"]
+            self.chat_identities.store(chat["telegram_chat_id"], chat_ids[chat["telegram_chat_id"]],
+                                       self._chat_fingerprint(chat))
+            user = row["user"]
+            if user:
+                self.user_identities.store(user["telegram_user_id"], user_ids[user["telegram_user_id"]],
+                                           self._user_fingerprint(user))
+    
+    async def save_messages_batch(self, rows: List[dict]) -> int:
+        """Сохранить пачку сообщений (см. message_to_row) одной транзакцией"""
+        if not rows:
+            return 0
+        
+        async with self.session() as db:
+            chat_ids = await self._resolve_chats(db, [row["chat"] for row in rows])
+            user_ids = await self._resolve_users(db, [row["user"] for row in rows if row["user"]])
+            
+            for row in rows:
+                self._add_message(db, row, chat_ids, user_ids)
+            
+            await db.commit()
+        
+        self._remember_identities(rows, chat_ids, user_ids)
+        logger.info(f"Saved {len(rows)} messages in one batch")
+        return len(rows)
+    
+    def _add_message(self, db: AsyncSession, row: dict, chat_ids: Dict[int, uuid.UUID],
+                     user_ids: Dict[int, uuid.UUID]) -> Message:
+        user = row["user"]
+        message = Message(
+            id=uuid.uuid4(),
+            chat_id=chat_ids[row["chat"]["telegram_chat_id"]],
+            user_id=user_ids[user["telegram_user_id"]] if user else None,
+            **row["message"]
+        )
+        db.add(message)
+        return message
+    
+    async def ingest_update(self, message, is_from_bot: bool = False,
+                            message_hash: Optional[str] = None) -> Dict[str, Optional[uuid.UUID]]:
+        """Сохранить чат, пользователя и сообщение Telegram в одной сессии одним коммитом.
+        
+        Возвращает только идентификаторы: chat_id, user_id, message_id.
+        """
+        row = message_to_row(message, is_from_bot=is_from_bot, message_hash=message_hash)
+        
+        async with self.session() as db:
+            chat_ids = await self._resolve_chats(db, [row["chat"]])
+            user_ids = await self._resolve_users(db, [row["user"]]) if row["user"] else {}
+            db_message = self._add_message(db, row, chat_ids, user_ids)
+            await db.commit()
+            
+            self._remember_identities([row], chat_ids, user_ids)
+            return {
+                "chat_id": db_message.chat_id,
+                "user_id": db_message.user_id,
+                "message_id": db_message.id,
+            }
+    
+    async def load_conversation_history(self, telegram_chat_id: int, limit: int) -> List[tuple]:
+        """Последние реплики чата для восстановления контекста: [(role, content), ...].
+        
+        Берется только то, что после последнего /clear. Хвост из сообщений
+        пользователя без ответа бота отбрасывается: это текущий ход, который
+        бот сам добавит в историю (или сообщения, оставшиеся без ответа).
+        """
+        async with self.session() as db:
+            messages = await MessageService.get_chat_history(
+                db, limit=limit, telegram_chat_id=telegram_chat_id
+            )
+        
+        history = []
+        for message in messages:
+            content = message.content or ""
+            if not message.is_from_bot and content.startswith("/clear"):
+                history = []
+                continue
+            if not content or content.startswith("/"):
+                continue
+            history.append(("assistant" if message.is_from_bot else "user", content))
+        
+        while history and history[-1][0] == "user":
+            history.pop()
+        return history
+    
+    async def get_config_changes(self, since: Optional[tuple]):
+        """События об изменившихся пресетах и настройках чатов с прошлого вызова.
+        
+        Возвращает (события, новая отметка); отметку нужно передать в следующий
+        вызов как since. Отметка — максимальный updated_at из БД (а не часы
+        бота) и уже отданные изменения: опрос каждый раз заглядывает на
+        CONFIG_POLL_OVERLAP назад, а повторы отбрасываются. При since=None
+        событий нет, возвращается только начальная отметка.
+        """
+        async with self.session() as db:
+            if since is None:
+                preset_max = (await db.execute(select(func.max(Preset.updated_at)))).scalar()
+                settings_max = (await db.execute(select(func.max(ChatSettings.updated_at)))).scalar()
+                marks = [mark for mark in (preset_max, settings_max) if mark is not None]
+                # Пустые таблицы — отметки нет, следующий опрос возьмет все строки
+                return [], (max(marks) if marks else None, frozenset())
+            
+            mark, seen = since
+            preset_query = select(Preset.id, Preset.updated_at)
+            chat_query = (
+                select(Chat.telegram_chat_id, ChatSettings.updated_at)
+                .join(ChatSettings, ChatSettings.chat_id == Chat.id)
+            )
+            if mark is not None:
+                floor = mark - CONFIG_POLL_OVERLAP
+                preset_query = preset_query.filter(Preset.updated_at >= floor)
+                chat_query = chat_query.filter(ChatSettings.updated_at >= floor)
+            presets = (await db.execute(preset_query)).all()
+            chats = (await db.execute(chat_query)).all()
+        
+        changes = {("preset", preset_id, updated_at) for preset_id, updated_at in presets}
+        changes |= {("chat", telegram_chat_id, updated_at) for telegram_chat_id, updated_at in chats}
+        events = [
+            preset_event(entity_id) if kind == "preset" else chat_event(entity_id)
+            for kind, entity_id, _ in changes - seen
+        ]
+        marks = [updated_at for _, _, updated_at in changes if updated_at is not None]
+        if mark is not None:
+            marks.append(mark)
+        if not marks:
+            return events, (None, frozenset())
+        mark = max(marks)
+        # Помним только то, что попадет в окно следующего опроса
+        floor = mark - CONFIG_POLL_OVERLAP
+        return events, (mark, frozenset(change for change in changes if change[2] is not None and change[2] >= floor))
+    
     async def get_chat_settings(self, telegram_chat_id: int) -> Optional[ChatSettings]:
         """Получить настройки чата"""
         async with self.session() as db:
@@ -146,21 +332,170 @@ class BotDatabaseIntegration:
             
             return preset
 
+    def identity_stats(self) -> dict:
+        """Размер и попадания кэшей Telegram ID -> UUID"""
+        return {"chats": self.chat_identities.stats(), "users": self.user_identities.stats()}
+    
+    def _cached_default_preset(self):
+        """(есть ли в кэше, пресет по умолчанию); пресета может и не быть — это тоже кэшируется"""
+        loaded_at = self._default_preset_loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > DEFAULT_PRESET_TTL:
+            return False, None
+        return True, self._default_preset
+    
+    def invalidate_default_preset(self):
+        """Забыть пресет по умолчанию (после изменения любого пресета)"""
+        self._default_preset_version += 1
+        self._default_preset_loaded_at = None
+    
+    async def get_effective_config(self, telegram_chat_id: int):
+        """Настройки чата и действующий пресет одним запросом: (ChatSettings | None, Preset | None).
+        
+        Назначенный пресет и пресет по умолчанию присоединяются внешними
+        join'ами к строке-якорю, поэтому строка есть, даже если чата еще нет
+        в БД. Пока пресет по умолчанию лежит в кэше процесса, его join не нужен.
+        """
+        default_version = self._default_preset_version
+        default_cached, default_preset = self._cached_default_preset()
+        assigned = aliased(Preset)
+        default = aliased(Preset)
+        anchor = select(literal(1).label("anchor")).subquery()
+        
+        columns = [ChatSettings, assigned] if default_cached else [ChatSettings, assigned, default]
+        query = (
+            select(*columns)
+            .select_from(anchor)
+            .outerjoin(Chat, Chat.telegram_chat_id == telegram_chat_id)
+            .outerjoin(ChatSettings, ChatSettings.chat_id == Chat.id)
+            .outerjoin(assigned, assigned.id == ChatSettings.preset_id)
+        )
+        if not default_cached:
+            query = query.outerjoin(default, default.is_default == true())
+        
+        async with self.session() as db:
+            row = (await db.execute(query.limit(1))).first()
+        
+        if not default_cached:
+            chat_settings, preset, default_preset = row if row else (None, None, None)
+            if default_version == self._default_preset_version:
+                self._default_preset = default_preset
+                self._default_preset_loaded_at = time.monotonic()
+        else:
+            chat_settings, preset = row if row else (None, None)
+        
+        return chat_settings, preset or default_preset
+
 # Глобальный экземпляр для использования в боте
 bot_db = BotDatabaseIntegration()
 
+# Таймаут (в секундах) на один запрос к БД из синхронного кода бота
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "10"))
+
+class DatabaseLoop:
+    """Долгоживущий цикл событий, которому принадлежат соединения async_engine.
+    
+    Пул соединений aiosqlite/asyncpg привязан к циклу, на котором они созданы,
+    поэтому все запросы бота выполняются на одном цикле в отдельном потоке,
+    а не на временных циклах, создаваемых на каждый вызов.
+    """
+    
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Цикл БД (запускается при первом обращении)"""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._start()
+            return self._loop
+    
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        
+        def _run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+        
+        thread = threading.Thread(target=_run, name="bot-db-loop", daemon=True)
+        thread.start()
+        ready.wait()
+        
+        self._loop, self._thread = loop, thread
+        logger.info("Database loop thread started")
+    
+    def adopt(self, loop: asyncio.AbstractEventLoop):
+        """Использовать уже работающий цикл (asyncio-режим бота) как цикл БД.
+        
+        Если до этого успел запуститься собственный поток цикла, его соединения
+        закрываются и поток останавливается: к новому циклу они не подойдут.
+        """
+        self.stop()
+        with self._lock:
+            self._loop, self._thread = loop, None
+    
+    def _in_loop_thread(self, loop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+    
+    def run(self, coro, timeout: Optional[float] = DB_CALL_TIMEOUT):
+        """Выполнить корутину на цикле БД и дождаться результата (из синхронного кода)"""
+        loop = self.loop
+        if self._in_loop_thread(loop):
+            coro.close()
+            raise RuntimeError("run_async() called from the database loop itself; await the coroutine instead")
+        
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Database call timed out after {timeout}s")
+    
+    async def release(self):
+        """Отпустить принятый через adopt цикл до его закрытия.
+        
+        Вызывается на самом цикле: соединения пула закрываются, пока он еще
+        работает, а следующий run() поднимет собственный поток цикла.
+        """
+        await async_engine.dispose()
+        with self._lock:
+            if self._thread is None:
+                self._loop = None
+    
+    def stop(self, timeout: float = 5.0):
+        """Закрыть соединения и остановить поток цикла БД"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if thread is None or loop is None or loop.is_closed():
+                return
+            self._loop, self._thread = None, None
+        
+        try:
+            asyncio.run_coroutine_threadsafe(async_engine.dispose(), loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"Failed to dispose database engine: {e}")
+        
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        if not thread.is_alive():
+            loop.close()
+        logger.info("Database loop thread stopped")
+
+db_loop = DatabaseLoop()
+atexit.register(db_loop.stop)
+
 # Вспомогательные функции для синхронного использования в боте
-def run_async(coro):
-    """Запустить асинхронную функцию в синхронном контексте"""
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # Если уже есть запущенный цикл, создаем новую задачу
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, coro)
-                return future.result()
-        else:
-            return loop.run_until_complete(coro)
-    except RuntimeError:
-        return asyncio.run(coro)
\ No newline at end of file
+def run_async(coro, timeout: Optional[float] = DB_CALL_TIMEOUT):
+    """Запустить асинхронную функцию в синхронном контексте (на общем цикле БД)"""
+    return db_loop.run(coro, timeout)
+
+# Очередь отложенной записи сообщений: ответ пользователю не ждет коммитов
+message_writer = MessageWriteQueue(lambda rows: run_async(bot_db.save_messages_batch(rows)))
+atexit.register(message_writer.stop)
@@ -0,0 +1,125 @@
+"""
+События изменения конфигурации (пресеты, настройки чатов) от админки к боту.
+
+Админка публикует событие в Redis после изменения, бот подписан и точечно
+сбрасывает свой кэш конфигов. Если Redis недоступен, бот опрашивает БД
+по updated_at, пока не удастся переподключиться.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+CONFIG_EVENTS_CHANNEL = os.getenv("CONFIG_EVENTS_CHANNEL", "kirillgpt:config")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Интервал опроса БД, пока Redis недоступен (секунды)
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "30"))
+# Как часто пробовать снова подключиться к Redis (секунды)
+REDIS_RETRY_INTERVAL = 60.0
+
+def preset_event(preset_id) -> dict:
+    return {"type": "preset", "preset_id": str(preset_id)}
+
+def chat_event(telegram_chat_id: int) -> dict:
+    return {"type": "chat", "telegram_chat_id": telegram_chat_id}
+
+async def publish_config_event(redis_client, event: dict) -> bool:
+    """Опубликовать событие (redis_client — redis.asyncio клиент админки или None)"""
+    if redis_client is None:
+        return False
+    try:
+        await redis_client.publish(CONFIG_EVENTS_CHANNEL, json.dumps(event))
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to publish config event: {e}")
+        return False
+
+class ConfigEventSubscriber:
+    """Поток бота, получающий события изменения конфигурации.
+
+    on_event(event) вызывается для каждого события. poll_changes(since)
+    возвращает (события, новая отметка) по изменениям в БД с прошлого вызова
+    (since=None — только получить текущую отметку); используется, пока Redis
+    недоступен, и один раз после каждого подключения, чтобы не потерять
+    изменения за время разрыва.
+    """
+
+    def __init__(self, on_event: Callable[[dict], None], poll_changes: Callable,
+                 redis_url: Optional[str] = REDIS_URL, poll_interval: float = CONFIG_POLL_INTERVAL):
+        self.on_event = on_event
+        self.poll_changes = poll_changes
+        self.redis_url = redis_url
+        self.poll_interval = poll_interval
+        self._since = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.received = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="config-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        self._poll()  # запоминаем начальную отметку
+        while not self._stop_event.is_set():
+            if self.redis_url and redis is not None:
+                try:
+                    self._listen()
+                    continue
+                except Exception as e:
+                    logger.warning(f"Config events: Redis unavailable ({e}), polling database")
+
+            deadline = time.monotonic() + REDIS_RETRY_INTERVAL
+            while not self._stop_event.wait(self.poll_interval):
+                self._poll()
+                if self.redis_url and redis is not None and time.monotonic() >= deadline:
+                    break
+
+    def _listen(self):
+        client = redis.Redis.from_url(self.redis_url, decode_responses=True)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CONFIG_EVENTS_CHANNEL)
+            logger.info("Config events: subscribed to Redis")
+            # Изменения, сделанные пока подписки не было
+            self._poll()
+            while not self._stop_event.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message and message.get("type") == "message":
+                    try:
+                        self._dispatch(json.loads(message["data"]))
+                    except ValueError:
+                        logger.warning("Config events: malformed message")
+        finally:
+            pubsub.close()
+            client.close()
+
+    def _poll(self):
+        try:
+            events, self._since = self.poll_changes(self._since)
+        except Exception as e:
+            logger.error(f"Config events: database poll failed: {e}")
+            return
+        for event in events:
+            self._dispatch(event)
+
+    def _dispatch(self, event: dict):
+        self.received += 1
+        try:
+            self.on_event(event)
+        except Exception as e:
+            logger.error(f"Config events: handler failed: {e}")
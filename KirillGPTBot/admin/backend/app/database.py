@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, MetaData, inspect, text
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 import os
@@ -72,4 +72,29 @@ async def get_db():
         try:
             yield session
         finally:
-            await session.close()
\ No newline at end of file
+            await session.close()
+
+def add_missing_columns(sync_conn):
+    """Добавить в существующие таблицы новые nullable-колонки моделей.
+    
+    create_all не меняет уже созданные таблицы, поэтому после него вызывается
+    эта функция (через conn.run_sync). NOT NULL колонки без значения по
+    умолчанию так не добавить — они только логируются.
+    """
+    inspector = inspect(sync_conn)
+    preparer = sync_conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning(f"Column {table.name}.{column.name} is missing and is NOT NULL; add it manually")
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(
+                f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+            ))
+            logger.info(f"Added column {table.name}.{column.name}")
@@ -0,0 +1,51 @@
+"""
+Кэш соответствия Telegram ID -> внутренний UUID для чатов и пользователей
+"""
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+import threading
+import uuid
+
+class IdentityCache:
+    """LRU-кэш Telegram ID -> (UUID, отпечаток профиля).
+    
+    Отпечаток — хэш полей профиля (username, имя, название чата...). Если он
+    совпадает с пришедшим в апдейте, строку в БД можно не читать и не обновлять.
+    """
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, Tuple[uuid.UUID, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def fingerprint(*fields: Hashable) -> int:
+        return hash(fields)
+    
+    def lookup(self, telegram_id: int, fingerprint: int) -> Optional[uuid.UUID]:
+        """UUID из кэша, если запись есть и отпечаток не изменился"""
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[1] != fingerprint:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry[0]
+    
+    def store(self, telegram_id: int, internal_id: uuid.UUID, fingerprint: int):
+        with self._lock:
+            self._entries[telegram_id] = (internal_id, fingerprint)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -19,13 +19,14 @@ except ImportError:
     logging.warning("Redis not available. Real-time features will be limited.")
 
 from . import models, schemas
-from .database import get_db, async_engine, Base
+from .database import get_db, async_engine, Base, add_missing_columns
 from .websocket import ConnectionManager
 from .services.message_service import MessageService
 from .services.preset_service import PresetService
 from .services.chat_service import ChatService
 from .auth import verify_token, verify_websocket_token
 from .bot_integration import BotDatabaseIntegration
+from .config_events import publish_config_event, preset_event, chat_event, REDIS_URL
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -55,12 +56,13 @@ async def startup():
         # Создаем таблицы если их нет
         async with async_engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(add_missing_columns)
         logger.info("Database tables created/verified")
         
         # Подключаемся к Redis (если доступен)
         if REDIS_AVAILABLE and redis is not None:
             try:
-                redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
+                redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
                 await redis_client.ping()
                 logger.info("Connected to Redis")
             except Exception as e:
@@ -206,6 +208,11 @@ async def update_chat_settings(
 ):
     updated_settings = await ChatService.update_chat_settings(db, chat_id, settings)
     
+    # Бот сбрасывает кэш конфига только этого чата
+    chat = await db.get(models.Chat, chat_id)
+    if chat:
+        await publish_config_event(redis_client, chat_event(chat.telegram_chat_id))
+    
     # Broadcast settings change
     await manager.broadcast(json.dumps({
         "type": "chat_settings_changed",
@@ -230,7 +237,11 @@ async def create_preset(
     db: AsyncSession = Depends(get_db),
     token: str = Depends(verify_token)
 ):
-    return await PresetService.create_preset(db, preset)
+    created_preset = await PresetService.create_preset(db, preset)
+    if created_preset.is_default:
+        # Сменился пресет по умолчанию — боту нужно перечитать чаты без своего пресета
+        await publish_config_event(redis_client, preset_event(created_preset.id))
+    return created_preset
 
 @app.get("/api/presets/{preset_id}", response_model=schemas.Preset)
 async def get_preset(preset_id: UUID, db: AsyncSession = Depends(get_db)):
@@ -250,6 +261,8 @@ async def update_preset(
     if not updated_preset:
         raise HTTPException(status_code=404, detail="Preset not found")
     
+    await publish_config_event(redis_client, preset_event(preset_id))
+    
     # Broadcast preset change
     await manager.broadcast(json.dumps({
         "type": "preset_changed",
@@ -273,6 +286,8 @@ async def delete_preset(
     if not success:
         raise HTTPException(status_code=404, detail="Preset not found")
     
+    await publish_config_event(redis_client, preset_event(preset_id))
+    
     await manager.broadcast(json.dumps({
         "type": "preset_deleted",
         "preset_id": str(preset_id)
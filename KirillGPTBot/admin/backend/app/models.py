@@ -66,6 +66,9 @@ class Preset(Base):
     verbosity: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
     emotional_intensity: Mapped[Optional[int]] = mapped_column(Integer, default=50)
     system_prompt_override: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    history_token_budget: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # Кэшировать ответы бота на точные повторы реплик
+    response_cache_enabled: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True, default=False)
     is_default: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -81,6 +84,8 @@ class ChatSettings(Base):
     auto_reply_enabled: Mapped[bool] = mapped_column(Boolean, default=True)
     reply_on_mention_enabled: Mapped[bool] = mapped_column(Boolean, default=True)
     temporary_preset_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Область диалога бота: user, chat или chat_user (NULL — значение по умолчанию бота)
+    conversation_scope: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
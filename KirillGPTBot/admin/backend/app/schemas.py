@@ -1,5 +1,5 @@
 from pydantic import BaseModel, ConfigDict
-from typing import Optional, List
+from typing import Optional, List, Literal
 from datetime import datetime
 from uuid import UUID
 from decimal import Decimal
@@ -70,6 +70,8 @@ class PresetBase(BaseModel):
     verbosity: Optional[str] = None
     emotional_intensity: Optional[int] = 50
     system_prompt_override: Optional[str] = None
+    history_token_budget: Optional[int] = None
+    response_cache_enabled: Optional[bool] = False
     is_default: bool = False
 
 class PresetCreate(PresetBase):
@@ -84,6 +86,8 @@ class PresetUpdate(BaseModel):
     verbosity: Optional[str] = None
     emotional_intensity: Optional[int] = None
     system_prompt_override: Optional[str] = None
+    history_token_budget: Optional[int] = None
+    response_cache_enabled: Optional[bool] = None
     is_default: Optional[bool] = None
 
 class Preset(PresetBase):
@@ -97,6 +101,7 @@ class ChatSettingsBase(BaseModel):
     auto_reply_enabled: bool = True
     reply_on_mention_enabled: bool = True
     temporary_preset_until: Optional[datetime] = None
+    conversation_scope: Optional[Literal["user", "chat", "chat_user"]] = None
 
 class ChatSettingsCreate(ChatSettingsBase):
     chat_id: UUID
@@ -107,6 +112,7 @@ class ChatSettingsUpdate(BaseModel):
     auto_reply_enabled: Optional[bool] = None
     reply_on_mention_enabled: Optional[bool] = None
     temporary_preset_until: Optional[datetime] = None
+    conversation_scope: Optional[Literal["user", "chat", "chat_user"]] = None
 
 class ChatSettings(ChatSettingsBase):
     model_config = ConfigDict(from_attributes=True)
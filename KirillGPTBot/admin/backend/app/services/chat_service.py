@@ -5,6 +5,7 @@ from typing import Optional, List
 from uuid import UUID
 
 from .. import models, schemas
+from ..upsert import upsert_chats
 
 class ChatService:
     @staticmethod
@@ -64,35 +65,17 @@ class ChatService:
         chat_data: schemas.ChatCreate
     ) -> models.Chat:
         """Создание или обновление чата"""
-        # Проверяем, существует ли чат
-        existing_chat = await ChatService.get_chat_by_telegram_id(
-            db, chat_data.telegram_chat_id
-        )
+        # Один upsert вместо проверки и вставки: без гонки на уникальном telegram_chat_id
+        await upsert_chats(db, [chat_data.dict()])
+        await db.commit()
         
-        if existing_chat:
-            # Обновляем существующий чат
-            for field, value in chat_data.dict().items():
-                setattr(existing_chat, field, value)
-            await db.commit()
-            await db.refresh(existing_chat)
-            return existing_chat
-        else:
-            # Создаем новый чат
-            db_chat = models.Chat(**chat_data.dict())
-            db.add(db_chat)
-            await db.commit()
-            await db.refresh(db_chat)
-            
-            # Создаем настройки по умолчанию для нового чата
-            default_settings = models.ChatSettings(
-                chat_id=db_chat.id,
-                auto_reply_enabled=True,
-                reply_on_mention_enabled=True
-            )
-            db.add(default_settings)
-            await db.commit()
-            
-            return db_chat
+        result = await db.execute(
+            select(models.Chat)
+            .options(selectinload(models.Chat.settings))
+            .filter(models.Chat.telegram_chat_id == chat_data.telegram_chat_id)
+            .execution_options(populate_existing=True)
+        )
+        return result.scalar_one()
     
     @staticmethod
     async def get_chat_settings(
@@ -102,13 +102,23 @@ class MessageService:
     @staticmethod
     async def get_chat_history(
         db: AsyncSession,
-        chat_id: UUID,
-        limit: int = 20
+        chat_id: Optional[UUID] = None,
+        limit: int = 20,
+        telegram_chat_id: Optional[int] = None
     ) -> List[models.Message]:
-        """Получение истории чата (последние сообщения)"""
+        """Получение истории чата (последние сообщения, от старых к новым).
+        
+        Чат задается либо внутренним chat_id, либо telegram_chat_id — тогда
+        чат присоединяется в том же запросе.
+        """
+        query = select(models.Message)
+        if telegram_chat_id is not None:
+            query = query.join(models.Chat).filter(models.Chat.telegram_chat_id == telegram_chat_id)
+        else:
+            query = query.filter(models.Message.chat_id == chat_id)
+        
         result = await db.execute(
-            select(models.Message)
-            .filter(models.Message.chat_id == chat_id)
+            query
             .order_by(desc(models.Message.created_at))
             .limit(limit)
         )
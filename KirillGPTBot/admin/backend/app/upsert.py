@@ -0,0 +1,85 @@
+"""
+Пакетный upsert чатов и пользователей (INSERT ... ON CONFLICT DO UPDATE ... RETURNING)
+для SQLite и PostgreSQL
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func
+from typing import Dict, List
+import uuid
+
+from .models import Chat, User, ChatSettings
+
+def _dialect_insert(db: AsyncSession):
+    """insert() того диалекта, к которому подключена сессия"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upsert is not supported for dialect: {dialect}")
+    return insert
+
+def _last_per_key(rows: List[dict], key: str) -> List[dict]:
+    # В одном INSERT ... ON CONFLICT ключ не может повторяться — оставляем последнюю версию
+    return list({row[key]: row for row in rows}.values())
+
+async def upsert_chats(db: AsyncSession, rows: List[dict]) -> Dict[int, uuid.UUID]:
+    """Вставить или обновить чаты одним запросом; возвращает telegram_chat_id -> id.
+    
+    Новым чатам добавляются настройки по умолчанию (существующие не меняются).
+    Коммит остается за вызывающим кодом.
+    """
+    if not rows:
+        return {}
+    
+    insert = _dialect_insert(db)
+    values = [{"id": uuid.uuid4(), **row} for row in _last_per_key(rows, "telegram_chat_id")]
+    stmt = insert(Chat).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Chat.telegram_chat_id],
+        set_={
+            "chat_type": stmt.excluded.chat_type,
+            "title": stmt.excluded.title,
+            "username": stmt.excluded.username,
+            "updated_at": func.now(),
+        },
+    ).returning(Chat.telegram_chat_id, Chat.id)
+    result = await db.execute(stmt)
+    chat_ids = {telegram_chat_id: chat_id for telegram_chat_id, chat_id in result.all()}
+    
+    settings_stmt = insert(ChatSettings).values([
+        {
+            "id": uuid.uuid4(),
+            "chat_id": chat_id,
+            "auto_reply_enabled": True,
+            "reply_on_mention_enabled": True,
+        }
+        for chat_id in chat_ids.values()
+    ]).on_conflict_do_nothing(index_elements=[ChatSettings.chat_id])
+    await db.execute(settings_stmt)
+    
+    return chat_ids
+
+async def upsert_users(db: AsyncSession, rows: List[dict]) -> Dict[int, uuid.UUID]:
+    """Вставить или обновить пользователей одним запросом; возвращает telegram_user_id -> id.
+    
+    Коммит остается за вызывающим кодом.
+    """
+    if not rows:
+        return {}
+    
+    insert = _dialect_insert(db)
+    values = [{"id": uuid.uuid4(), **row} for row in _last_per_key(rows, "telegram_user_id")]
+    stmt = insert(User).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_user_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "updated_at": func.now(),
+        },
+    ).returning(User.telegram_user_id, User.id)
+    result = await db.execute(stmt)
+    return {telegram_user_id: user_id for telegram_user_id, user_id in result.all()}
@@ -0,0 +1,51 @@
+"""
+Прием обновлений Telegram через вебхук (альтернатива long polling)
+"""
+from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, Request
+from typing import Callable, List, Optional
+import hmac
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+
+def create_webhook_router(handle_updates: Callable[[List[dict]], None],
+                          secret_token: Optional[str] = TELEGRAM_WEBHOOK_SECRET,
+                          path: str = TELEGRAM_WEBHOOK_PATH) -> APIRouter:
+    """Роутер, принимающий обновления Telegram (одно или список) и передающий их в handle_updates.
+    
+    Секрет сверяется с заголовком X-Telegram-Bot-Api-Secret-Token. handle_updates
+    вызывается как фоновая задача уже после ответа, так что Telegram не ждет
+    обработки сообщений. Роутер можно подключить в любое FastAPI-приложение,
+    в том числе в app.main.
+    """
+    if not secret_token:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required for webhook mode")
+    
+    router = APIRouter()
+    
+    @router.post(path)
+    async def telegram_webhook(
+        request: Request,
+        background_tasks: BackgroundTasks,
+        x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+    ):
+        if not hmac.compare_digest(x_telegram_bot_api_secret_token or "", secret_token):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+        
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        
+        updates = payload if isinstance(payload, list) else [payload]
+        updates = [update for update in updates if isinstance(update, dict)]
+        if updates:
+            background_tasks.add_task(handle_updates, updates)
+        
+        return {"ok": True, "accepted": len(updates)}
+    
+    return router
@@ -0,0 +1,146 @@
+"""
+Отложенная (write-behind) запись сообщений бота в базу данных пачками
+"""
+from typing import Callable, List, Optional
+import os
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX", "10000"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "50"))
+WRITE_FLUSH_MS = int(os.getenv("WRITE_FLUSH_MS", "200"))
+
+class MessageWriteQueue:
+    """Ограниченная очередь строк для записи и фоновый поток, который её разбирает.
+    
+    Строки (см. bot_integration.message_to_row) собираются в пачку до batch_size
+    штук или до flush_ms миллисекунд и записываются одной транзакцией через
+    write_batch. При переполнении новые строки отбрасываются и учитываются
+    в счетчике dropped — ответ пользователю важнее истории в админке.
+    """
+    
+    def __init__(self, write_batch: Callable[[List[dict]], int],
+                 max_size: int = WRITE_QUEUE_MAX, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_ms: int = WRITE_FLUSH_MS):
+        self._write_batch = write_batch
+        self._queue: "queue.Queue[dict]" = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+    
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="bot-db-writer", daemon=True)
+                self._thread.start()
+    
+    def enqueue(self, row: dict) -> bool:
+        """Поставить строку в очередь без ожидания; False, если строка отброшена"""
+        if self._stopping.is_set():
+            return False
+        self._ensure_started()
+        
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 100 == 0:
+                logger.warning(f"Write queue is full, dropped {dropped} rows so far")
+            return False
+        
+        with self._stats_lock:
+            self.enqueued += 1
+        return True
+    
+    def _collect_batch(self) -> List[dict]:
+        """Дождаться первой строки и добрать пачку до batch_size или истечения flush_interval"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _drain_nowait(self) -> List[dict]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _flush(self, batch: List[dict]):
+        # Одна повторная попытка на случай временной ошибки (например, занятый файл SQLite)
+        for attempt in range(2):
+            try:
+                self._write_batch(batch)
+                with self._stats_lock:
+                    self.written += len(batch)
+                    self.batches += 1
+                return
+            except Exception as e:
+                if attempt == 1:
+                    logger.error(f"Failed to write batch of {len(batch)} messages: {e}")
+                    with self._stats_lock:
+                        self.failed += len(batch)
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._flush(batch)
+        
+        # Дописываем остаток при остановке
+        while True:
+            batch = self._drain_nowait()
+            if not batch:
+                break
+            self._flush(batch)
+    
+    def stop(self, timeout: float = 10.0):
+        """Остановить поток записи, дописав всё, что осталось в очереди"""
+        self._stopping.set()
+        if self._thread is None:
+            return
+        self._thread.join(timeout)
+        logger.info(f"Write queue stopped: {self.stats()}")
+    
+    def stats(self) -> dict:
+        """Счетчики очереди: глубина, записано, отброшено, ошибки"""
+        with self._stats_lock:
+            return {
+                "depth": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+            }
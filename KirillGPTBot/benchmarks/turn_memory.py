@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк памяти: хранение реплик истории словарями против Turn со слотами.
+
+Класс Turn берется прямо из bot.py (без импорта бота и его зависимостей).
+Запуск: python3 benchmarks/turn_memory.py [пользователей] [реплик на пользователя]
+"""
+import ast
+import os
+import random
+import sys
+import tracemalloc
+from collections import deque
+
+BOT_PATH = os.path.join(os.path.dirname(__file__), "..", "bot.py")
+
+SHORT_REPLIES = ["ок", "+", "ахах", "привет", "кто ты?", "да", "нет", "ну ты понял", "спс", "лол"]
+WORDS = "кирилл бот сегодня завтра работа погода машина деньги кофе проект друг вечер идея".split()
+
+def load_turn_class():
+    """Выполнить определение класса Turn из bot.py в отдельном пространстве имен"""
+    with open(BOT_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == "Turn":
+            namespace = {"sys": sys}
+            exec(compile(ast.Module(body=[node], type_ignores=[]), BOT_PATH, "exec"), namespace)
+            return namespace["Turn"]
+    raise RuntimeError("class Turn not found in bot.py")
+
+def make_text(rng):
+    """Как в живых чатах: много коротких повторяющихся реплик и длинные уникальные"""
+    if rng.random() < 0.4:
+        # Новый объект строки на каждое сообщение, как после разбора апдейта Telegram
+        return "".join(list(rng.choice(SHORT_REPLIES)))
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60)))
+
+def build(users, turns_per_user, make_turn):
+    rng = random.Random(42)
+    conversations = {}
+    for user_id in range(users):
+        history = deque(maxlen=turns_per_user)
+        for index in range(turns_per_user):
+            role = "user" if index % 2 == 0 else "assistant"
+            text = make_text(rng)
+            history.append(make_turn(role, text, len(text.encode("utf-8")) // 4 + 1))
+        conversations[user_id] = history
+    return conversations
+
+def measure(users, turns_per_user, make_turn):
+    tracemalloc.start()
+    conversations = build(users, turns_per_user, make_turn)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del conversations
+    return current
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    turns_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    Turn = load_turn_class()
+    
+    layouts = {
+        "dict {role, content}": lambda role, text, tokens: {"role": role, "content": text},
+        "Turn (__slots__)": lambda role, text, tokens: Turn(Turn.ROLE_CODES[role], text, tokens),
+    }
+    try:
+        from google.genai import types
+        layouts["tuple + types.Part"] = lambda role, text, tokens: (role, text, types.Part(text=text), tokens)
+    except ImportError:
+        pass
+    
+    total_turns = users * turns_per_user
+    # Сами тексты без обертки — чтобы показать накладные расходы на реплику отдельно
+    texts_only = measure(users, turns_per_user, lambda role, text, tokens: text)
+    print(f"{users} пользователей x {turns_per_user} реплик, тексты: {texts_only / 1024 / 1024:.1f} МБ")
+    
+    baseline = None
+    for name, make_turn in layouts.items():
+        size = measure(users, turns_per_user, make_turn)
+        baseline = baseline or size
+        overhead = (size - texts_only) / total_turns
+        print(f"  {name:24} {size / 1024 / 1024:8.1f} МБ  ({size / baseline:.0%})  "
+              f"сверх текста: {overhead:.0f} байт/реплика")
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,13 @@ import random
 import threading
 import hashlib
 import json
-from collections import defaultdict
+import queue
+import heapq
+import pickle
+import signal
+import functools
+import concurrent.futures
+from collections import OrderedDict, deque
 from io import BytesIO
 from PIL import Image
 import asyncio
@@ -26,85 +32,40 @@ logger = logging.getLogger(__name__)
 sys.path.append('admin/backend')
 
 try:
-    from app.bot_integration import bot_db, run_async
+    from app.bot_integration import bot_db, run_async, db_loop, message_writer, message_to_row
+    from app.config_events import ConfigEventSubscriber
     DATABASE_INTEGRATION_ENABLED = True
     logger.info("Database integration enabled")
 except ImportError as e:
     logger.warning(f"Database integration disabled: {e}")
     DATABASE_INTEGRATION_ENABLED = False
 
+# Отложенная запись сообщений пачками (0 — писать сразу, одной транзакцией на сообщение)
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND", "1") != "0"
+
 def save_user_message_to_db(message):
-    """Сохранить пользовательское сообщение в базу данных"""
+    """Сохранить пользовательское сообщение в базу данных (по умолчанию через очередь отложенной записи)"""
     if not DATABASE_INTEGRATION_ENABLED:
         return
     
     try:
-        # Создаем или получаем чат
-        chat = run_async(bot_db.get_or_create_chat(
-            telegram_chat_id=message.chat.id,
-            chat_type=message.chat.type,
-            title=getattr(message.chat, 'title', None),
-            username=getattr(message.chat, 'username', None)
-        ))
-        
-        # Создаем или получаем пользователя
-        user = run_async(bot_db.get_or_create_user(
-            telegram_user_id=message.from_user.id,
-            username=getattr(message.from_user, 'username', None),
-            first_name=getattr(message.from_user, 'first_name', None),
-            last_name=getattr(message.from_user, 'last_name', None),
-            is_bot=getattr(message.from_user, 'is_bot', False)
-        ))
-        
-        # Сохраняем сообщение
-        message_hash = hashlib.sha256((message.text or "").encode()).hexdigest()[:8]
-        run_async(bot_db.save_message(
-            telegram_message_id=message.message_id,
-            chat_id=chat.id,  # UUID объект, не строка
-            user_id=user.id,  # UUID объект, не строка
-            content=message.text or "",
-            message_type="text",
-            is_from_bot=False,
-            message_hash=message_hash
-        ))
-        
+        if WRITE_BEHIND_ENABLED:
+            message_writer.enqueue(message_to_row(message))
+        else:
+            run_async(bot_db.ingest_update(message))
     except Exception as e:
         logger.error(f"Error saving user message to database: {e}")
 
 def save_bot_message_to_db(bot_message, response_hash):
-    """Сохранить ответ бота в базу данных"""
+    """Сохранить ответ бота в базу данных (по умолчанию через очередь отложенной записи)"""
     if not DATABASE_INTEGRATION_ENABLED or not bot_message:
         return
     
     try:
-        # Получаем информацию о чате (уже должен существовать)
-        chat = run_async(bot_db.get_or_create_chat(
-            telegram_chat_id=bot_message.chat.id,
-            chat_type=bot_message.chat.type,
-            title=getattr(bot_message.chat, 'title', None),
-            username=getattr(bot_message.chat, 'username', None)
-        ))
-        
-        # Создаем пользователя-бота
-        bot_user = run_async(bot_db.get_or_create_user(
-            telegram_user_id=bot_message.from_user.id,
-            username=getattr(bot_message.from_user, 'username', None),
-            first_name=getattr(bot_message.from_user, 'first_name', None),
-            last_name=getattr(bot_message.from_user, 'last_name', None),
-            is_bot=True
-        ))
-        
-        # Сохраняем ответ бота
-        run_async(bot_db.save_message(
-            telegram_message_id=bot_message.message_id,
-            chat_id=chat.id,  # UUID объект, не строка
-            user_id=bot_user.id,  # UUID объект, не строка
-            content=bot_message.text or "",
-            message_type="text",
-            is_from_bot=True,
-            message_hash=response_hash
-        ))
-        
+        if WRITE_BEHIND_ENABLED:
+            message_writer.enqueue(message_to_row(bot_message, is_from_bot=True, message_hash=response_hash))
+        else:
+            run_async(bot_db.ingest_update(bot_message, is_from_bot=True, message_hash=response_hash))
     except Exception as e:
         logger.error(f"Error saving bot message to database: {e}")
 
@@ -121,8 +82,13 @@ if not GOOGLE_API_KEY:
     logger.error("GOOGLE_API_KEY не найден в переменных окружения")
     exit(1)
 
+# Количество рабочих полос: сообщения одного чата обрабатываются строго по порядку,
+# разные чаты — параллельно (0 — стандартный пул потоков TeleBot)
+WORKER_LANES = int(os.getenv("WORKER_LANES", "8"))
+
 # Инициализация бота и AI клиента
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+# С полосами обработчики TeleBot только ставят задачу в очередь, поэтому пул потоков ему не нужен
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=WORKER_LANES <= 0)
 client = genai.Client(api_key=GOOGLE_API_KEY)
 
 # Системный промпт для Кирилла GPT
@@ -155,20 +121,453 @@ KIRILL_SYSTEM_PROMPT = """
 
 # Конфигурация безопасности
 MAX_HISTORY = int(os.getenv("MAX_HISTORY", "20"))
+# Восстанавливать контекст личных чатов из БД после перезапуска (0 — начинать с пустой истории)
+HISTORY_HYDRATE = os.getenv("HISTORY_HYDRATE", "1") != "0"
 MAX_USER_MSG_LEN = int(os.getenv("MAX_USER_MSG_LEN", "2000"))
 RATE_WINDOW = float(os.getenv("RATE_WINDOW", "1.0"))  # секунды между сообщениями
 
-# Хранилище истории диалогов для каждого пользователя
-user_conversations = {}
+# Потоковые ответы: первое сообщение уходит с первым чанком, дальше оно редактируется
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # секунды между правками
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+
+# Ограничения памяти для состояния в процессе
+STATE_MAX_CONVERSATIONS = int(os.getenv("STATE_MAX_CONVERSATIONS", "10000"))
+STATE_IDLE_TTL = float(os.getenv("STATE_IDLE_TTL", "86400"))  # секунды простоя до вытеснения
+STATE_MEMORY_BUDGET_MB = float(os.getenv("STATE_MEMORY_BUDGET_MB", "256"))
+STATE_SPILL_DIR = os.getenv("STATE_SPILL_DIR", "")  # куда выгружать вытесненные диалоги (пусто — никуда)
+STATE_SPILL_TTL = float(os.getenv("STATE_SPILL_TTL", "2592000"))  # через сколько секунд выгрузка забывается (30 дней)
+
+class BoundedStateMap:
+    """Словарь с вытеснением по LRU, по времени простоя и по бюджету памяти.
+    
+    Обращение к ключу (get, [], set, touch) продлевает ему жизнь. Если задан
+    default_factory, [] создает отсутствующее значение, как defaultdict.
+    sizeof оценивает размер значения в байтах для бюджета max_bytes; после
+    изменения значения на месте нужно вызвать touch(key). can_evict(key, value)
+    позволяет запретить вытеснение занятых значений, on_evict(key, value) вызывается
+    для каждого вытесненного значения вне блокировки.
+    """
+    
+    def __init__(self, name, max_entries, idle_ttl=None, max_bytes=None, sizeof=None,
+                 default_factory=None, can_evict=None, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._default_factory = default_factory
+        self._can_evict = can_evict
+        self._on_evict = on_evict
+        
+        self._data = OrderedDict()  # key -> [value, last_access, size]
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _size(self, value):
+        return self._sizeof(value) if self._sizeof else 0
+    
+    def _store(self, key, value, now):
+        size = self._size(value)
+        previous = self._data.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= previous[2]
+        self._data[key] = [value, now, size]
+        self.total_bytes += size
+    
+    def _collect_evictions(self, now):
+        """Снять с головы LRU просроченные и лишние записи; возвращает вытесненные"""
+        evicted = []
+        freed = 0
+        for key, (value, last_access, size) in self._data.items():
+            expired = self.idle_ttl is not None and now - last_access > self.idle_ttl
+            over_limit = len(self._data) - len(evicted) > self.max_entries or (
+                self.max_bytes is not None and self.total_bytes - freed > self.max_bytes)
+            if not expired and not over_limit:
+                break
+            if self._can_evict is not None and not self._can_evict(key, value):
+                # Занятое значение остается на своем месте в LRU, смотрим следующее
+                continue
+            
+            freed += size
+            if expired:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+            evicted.append((key, value))
+        
+        for key, _ in evicted:
+            del self._data[key]
+        self.total_bytes -= freed
+        return evicted
+    
+    def _notify(self, evicted):
+        if self._on_evict is None:
+            return
+        for key, value in evicted:
+            try:
+                self._on_evict(key, value)
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки {self.name}[{key}]: {e}")
+    
+    def get(self, key, default=None):
+        evicted = []
+        value = default
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            now = time.monotonic()
+            if self.idle_ttl is not None and now - entry[1] > self.idle_ttl:
+                evicted = self._collect_evictions(now)
+            # Просроченное, но занятое значение (can_evict запретил) остается живым:
+            # иначе вызывающий создал бы новое поверх него, а старое не ушло бы в on_evict
+            if key in self._data:
+                entry[1] = now
+                self._data.move_to_end(key)
+                value = entry[0]
+        # Вытесненное значение уходит в on_evict до возврата, так что его можно сразу загрузить снова
+        self._notify(evicted)
+        return value
+    
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+    
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self._default_factory is None:
+            raise KeyError(key)
+        with self._lock:
+            # Другой поток мог создать значение, пока мы не держали блокировку
+            entry = self._data.get(key)
+            if entry is not None:
+                return entry[0]
+            value = self._default_factory()
+            self[key] = value
+            return value
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._store(key, value, now)
+            evicted = self._collect_evictions(now)
+        self._notify(evicted)
+    
+    def __delitem__(self, key):
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[2]
+            return entry[0]
+    
+    def touch(self, key):
+        """Пересчитать размер значения после изменения на месте и продлить ему жизнь"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return
+            now = time.monotonic()
+            self._store(key, entry[0], now)
+            evicted = self._collect_evictions(now)
+        self._notify(evicted)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def items(self):
+        """Снимок пар (key, value) от давно не использованных к недавним"""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._data.items()]
+    
+    def stats(self):
+        """Счетчики: записи, оценка памяти, вытеснения по лимитам и по простою"""
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.total_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+_MISSING = object()
+
+class ConversationSpill:
+    """Выгрузка вытесненных диалогов на диск и загрузка при следующем обращении"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, key):
+        name = hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f"{name}.json")
+    
+    def save(self, key, conversation):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(conversation.export(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+    
+    def load(self, key):
+        """Вернуть выгруженный диалог (файл удаляется) или None"""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось загрузить выгруженный диалог: {e}")
+            return None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return Conversation.restore(state)
+    
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    def sweep(self, max_age):
+        """Удалить выгрузки старше max_age секунд (диалоги, к которым не вернулись); возвращает число удаленных"""
+        removed = 0
+        cutoff = time.time() - max_age
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+conversation_spill = ConversationSpill(STATE_SPILL_DIR) if STATE_SPILL_DIR else None
+
+# Хранилище истории диалогов (ключ области диалога, см. conversation_key -> Conversation)
+user_conversations = BoundedStateMap(
+    "conversations",
+    max_entries=STATE_MAX_CONVERSATIONS,
+    idle_ttl=STATE_IDLE_TTL,
+    max_bytes=int(STATE_MEMORY_BUDGET_MB * 1024 * 1024),
+    sizeof=lambda conversation: conversation.approx_size(),
+    # Диалог, с которым сейчас может работать поток под locks[key], не вытесняем
+    can_evict=lambda key, conversation: not locks.held(key),
+    on_evict=conversation_spill.save if conversation_spill else None
+)
+
+class StripedLocks:
+    """Фиксированная таблица блокировок: ключ хэшируется на одну из полос.
+    
+    Память не растет с числом пользователей и чатов, а разные ключи на одной
+    полосе лишь изредка ждут друг друга. Брать две блокировки из таблицы
+    одновременно нельзя: ключи могут попасть на одну полосу.
+    """
+    
+    def __init__(self, name, stripes):
+        self.name = name
+        self._locks = [threading.Lock() for _ in range(stripes)]
+    
+    def __getitem__(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+    
+    def held(self, key):
+        return self[key].locked()
+    
+    def stats(self):
+        return {"stripes": len(self._locks), "held": sum(lock.locked() for lock in self._locks)}
 
 # Thread safety и rate limiting
-locks = defaultdict(threading.Lock)
-last_message_time = {}
+LOCK_STRIPES = int(os.getenv("LOCK_STRIPES", "256"))
+locks = StripedLocks("locks", LOCK_STRIPES)
+last_message_time = BoundedStateMap(
+    "rate_limits",
+    max_entries=STATE_MAX_CONVERSATIONS,
+    idle_ttl=max(RATE_WINDOW, 60.0)
+)
 
-# Кэширование настроек чатов для производительности
-chat_settings_cache = {}
+# Кэширование настроек чатов для производительности.
+# Изменения из админки приходят событиями (CONFIG_EVENTS), поэтому кэш можно держать часами;
+# без событий — 5 минут, как раньше. С событиями TTL — страховка на случай потерянного события
+CONFIG_EVENTS_ENABLED = os.getenv("CONFIG_EVENTS", "1") != "0"
+CACHE_TTL = float(os.getenv("CHAT_CONFIG_TTL", "3600" if CONFIG_EVENTS_ENABLED else "300"))
+# Сколько еще после CACHE_TTL можно отдавать устаревший конфиг, пока он обновляется в фоне
+CONFIG_STALE_GRACE = float(os.getenv("CHAT_CONFIG_STALE_GRACE", str(CACHE_TTL)))
+CONFIG_ERROR_TTL = 10.0  # после ошибки загрузки не идем в БД за этим чатом столько секунд
+chat_settings_cache = BoundedStateMap(
+    "chat_configs",
+    max_entries=STATE_MAX_CONVERSATIONS,
+    idle_ttl=CACHE_TTL + CONFIG_STALE_GRACE
+)
 settings_cache_lock = threading.Lock()
-CACHE_TTL = 300  # 5 минут кэширования
+# Растет с каждым событием изменения конфига: загрузка, начатая до события, не кладет в кэш старые данные
+config_generation = 0
+
+class ChatLaneDispatcher:
+    """Пул рабочих потоков, шардированный по чатам.
+    
+    Каждый чат хэшируется на одну из полос — очередь с собственным потоком.
+    Внутри полосы задачи выполняются строго в порядке поступления, поэтому
+    ответы одному чату не перемешиваются, а разные чаты обрабатываются параллельно.
+    """
+    
+    def __init__(self, lanes):
+        self._queues = [queue.Queue() for _ in range(lanes)]
+        self._threads = []
+        self._start_lock = threading.Lock()
+    
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for index, lane in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker, args=(lane,), name=f"chat-lane-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+    
+    def lane_for(self, key):
+        """Номер полосы для ключа (telegram chat id)"""
+        return hash(key) % len(self._queues)
+    
+    def submit(self, key, func, *args):
+        """Поставить задачу в полосу ключа"""
+        self._ensure_started()
+        self._queues[self.lane_for(key)].put((func, args))
+    
+    def _worker(self, lane):
+        while True:
+            task = lane.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                func(*args)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике полосы: {e}")
+            finally:
+                lane.task_done()
+    
+    def depths(self):
+        """Глубина очереди каждой полосы"""
+        return [lane.qsize() for lane in self._queues]
+    
+    def stop(self, timeout=10.0):
+        """Дождаться выполнения поставленных задач и остановить потоки"""
+        for lane in self._queues:
+            lane.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+lane_dispatcher = ChatLaneDispatcher(WORKER_LANES) if WORKER_LANES > 0 else None
+
+def run_in_chat_lane(chat_id, func, *args):
+    """Выполнить задачу в полосе чата (без полос — сразу в текущем потоке)"""
+    if lane_dispatcher is None:
+        return func(*args)
+    lane_dispatcher.submit(chat_id, func, *args)
+
+def in_chat_lane(handler):
+    """Выполнять обработчик в полосе чата, а не в потоке поллинга"""
+    @functools.wraps(handler)
+    def wrapper(message):
+        chat_id = message.chat.id
+        if turn_debouncer is not None:
+            # Текст, отправленный до команды, должен обработаться раньше нее
+            turn_debouncer.flush(lambda key: key[0] == chat_id)
+        return run_in_chat_lane(chat_id, handler, message)
+    return wrapper
+
+# Окно склейки сообщений (секунды): сообщения пользователя, пришедшие в течение окна после первого,
+# отвечаются одним запросом к модели (0 — отвечать на каждое сообщение отдельно)
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "0"))
+
+class TurnDebouncer:
+    """Склеивает серию быстрых сообщений одного пользователя в один ход.
+    
+    Первое сообщение открывает ход и запускает окно; всё, что приходит по тому же
+    ключу до его закрытия, дописывается в ход. По истечении окна on_turn(key, messages)
+    вызывается из потока-планировщика — потоки обработчиков при этом не ждут.
+    """
+    
+    def __init__(self, window, on_turn):
+        self.window = window
+        self._on_turn = on_turn
+        self._pending = {}
+        self._deadlines = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def add(self, key, message):
+        """Добавить сообщение в ход; True, если оно открыло новый ход"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="turn-debouncer", daemon=True)
+                self._thread.start()
+            
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append(message)
+                return False
+            
+            self._pending[key] = [message]
+            self._sequence += 1
+            heapq.heappush(self._deadlines, (time.monotonic() + self.window, self._sequence, key))
+            self._cond.notify()
+            return True
+    
+    def flush(self, match):
+        """Закрыть досрочно все открытые ходы, ключ которых подходит под match(key).
+        
+        on_turn вызывается в текущем потоке до возврата, поэтому то, что вызывающий
+        поставит в полосу следом, выполнится уже после этих ходов.
+        """
+        with self._cond:
+            keys = [key for key in self._pending if match(key)]
+            turns = [(key, self._pending.pop(key)) for key in keys]
+        # Записи в _deadlines остаются: для них _run просто не найдет хода
+        for key, messages in turns:
+            try:
+                self._on_turn(key, messages)
+            except Exception as e:
+                logger.error(f"Ошибка обработки склеенного хода: {e}")
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._deadlines:
+                    self._cond.wait()
+                deadline, _, key = self._deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._deadlines)
+                messages = self._pending.pop(key, None)
+            
+            if messages:
+                try:
+                    self._on_turn(key, messages)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки склеенного хода: {e}")
 
 def sanitize_user_message(text):
     """Очистка пользовательского сообщения от попыток prompt injection"""
@@ -189,12 +588,527 @@ def sanitize_user_message(text):
     
     return text.strip()
 
+class ApproxTokenCounter:
+    """Локальная оценка числа токенов без запросов к API.
+    
+    Для Gemini токен в среднем около 4 байт UTF-8: латиница ~4 символа,
+    кириллица ~2 символа на токен.
+    """
+    
+    def count(self, text):
+        return len(text.encode("utf-8")) // 4 + 1
+    
+    async def count_async(self, text):
+        return self.count(text)
+
+class GeminiTokenCounter:
+    """Точный подсчет через models.count_tokens; при ошибке — локальная оценка"""
+    
+    def __init__(self, client, model, fallback=None):
+        self.client = client
+        self.model = model
+        self.fallback = fallback or ApproxTokenCounter()
+    
+    def count(self, text):
+        try:
+            return self.client.models.count_tokens(model=self.model, contents=text).total_tokens
+        except Exception as e:
+            logger.warning(f"count_tokens failed, using estimate: {e}")
+            return self.fallback.count(text)
+    
+    async def count_async(self, text):
+        """То же через client.aio, не блокируя цикл событий"""
+        try:
+            response = await self.client.aio.models.count_tokens(model=self.model, contents=text)
+            return response.total_tokens
+        except Exception as e:
+            logger.warning(f"count_tokens failed, using estimate: {e}")
+            return self.fallback.count(text)
+
+TEXT_MODEL = "gemini-2.0-flash-exp"
+
+# Бюджет токенов истории по умолчанию (пресет может задать свой history_token_budget; 0 — без ограничения)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+# approx — локальная оценка, gemini — запрос count_tokens на каждую новую реплику
+TOKEN_COUNTER = os.getenv("TOKEN_COUNTER", "approx")
+
+# Сжатие вытесненных реплик в краткое содержание фоновым запросом к модели (0 — реплики просто забываются)
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "0") != "0"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-2.0-flash-lite")
+SUMMARY_MIN_TURNS = int(os.getenv("SUMMARY_MIN_TURNS", "4"))  # копим столько вытесненных реплик перед запросом
+
+# Оценка для массовых подсчетов (история из БД), где запрос на каждую реплику слишком дорог
+approx_token_counter = ApproxTokenCounter()
+token_counter = (
+    GeminiTokenCounter(client, TEXT_MODEL, approx_token_counter) if TOKEN_COUNTER == "gemini"
+    else approx_token_counter
+)
+
+class Turn:
+    """Реплика истории в компактном виде.
+    
+    role — маленькое число (Turn.USER / Turn.ASSISTANT), content интернирован:
+    одинаковые короткие реплики ("ок", "+") хранятся одной строкой на все
+    диалоги. Хэш считается один раз и переиспользуется при сравнении историй.
+    """
+    
+    __slots__ = ("role", "content", "tokens", "hash")
+    
+    USER = 0
+    ASSISTANT = 1
+    ROLE_CODES = {"user": USER, "assistant": ASSISTANT}
+    ROLE_NAMES = ("user", "assistant")
+    API_ROLES = ("user", "model")  # роли Gemini API
+    
+    def __init__(self, role, content, tokens):
+        self.role = role
+        self.content = sys.intern(content)
+        self.tokens = tokens
+        self.hash = hash((role, self.content))
+    
+    @property
+    def role_name(self):
+        return self.ROLE_NAMES[self.role]
+
+class Conversation:
+    """История диалога в кольцевом буфере на MAX_HISTORY реплик (Turn).
+    
+    Реплики хранятся уже очищенными, поэтому при каждом ходе история не
+    санитизируется заново; список types.Content для запроса собирается из
+    них при каждом ходе — держать pydantic-объекты в памяти для тысяч
+    диалогов дороже, чем собрать два десятка. Системный промпт сюда не
+    входит — он передается отдельно как system_instruction.
+    Число токенов реплики считается один раз при добавлении и хранится рядом,
+    так что обрезка по бюджету токенов не требует пересчета.
+    
+    При SUMMARY_ENABLED вытесненные реплики копятся в evicted, пока
+    HistorySummarizer не свернет их в summary, которое идет перед историей.
+    """
+    
+    def __init__(self, max_turns=MAX_HISTORY):
+        self.turns = deque(maxlen=max_turns)
+        self.total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.evicted = []
+    
+    def append(self, role, content, tokens=None):
+        """Добавить реплику (content должен быть уже очищен sanitize_user_message).
+        
+        tokens — заранее посчитанное число токенов; если не задано, считается
+        token_counter'ом (для GeminiTokenCounter это запрос к API, поэтому
+        под блокировкой лучше передавать готовое значение).
+        """
+        if tokens is None:
+            tokens = token_counter.count(content)
+        if len(self.turns) == self.turns.maxlen:
+            old = self.turns[0]
+            self.total_tokens -= old.tokens
+            self._keep_evicted([(old.role_name, old.content)])
+        self.turns.append(Turn(Turn.ROLE_CODES[role], content, tokens))
+        self.total_tokens += tokens
+    
+    @staticmethod
+    def count_tokens(content):
+        """Число токенов реплики"""
+        return token_counter.count(content)
+    
+    @staticmethod
+    async def count_tokens_async(content):
+        """count_tokens для корутин"""
+        return await token_counter.count_async(content)
+    
+    def trim_to_budget(self, budget):
+        """Вытеснить старые реплики, пока история (вместе с summary) не уложится в budget токенов.
+        
+        Последняя реплика остается всегда. Возвращает вытесненные реплики
+        в виде [(role, content), ...].
+        """
+        evicted = []
+        if not budget:
+            return evicted
+        while len(self.turns) > 1 and self.total_tokens + self.summary_tokens > budget:
+            turn = self.turns.popleft()
+            self.total_tokens -= turn.tokens
+            evicted.append((turn.role_name, turn.content))
+        if evicted:
+            self._keep_evicted(evicted)
+        return evicted
+    
+    def _keep_evicted(self, turns):
+        if not SUMMARY_ENABLED:
+            return
+        self.evicted.extend(turns)
+        # Если сжатие долго не удается, не копим бесконечно
+        del self.evicted[:-2 * self.turns.maxlen]
+    
+    def take_evicted(self):
+        """Забрать накопленные вытесненные реплики для сжатия"""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+    
+    def set_summary(self, summary, tokens=None):
+        self.summary = summary
+        self.summary_tokens = tokens if tokens is not None else (token_counter.count(summary) if summary else 0)
+    
+    def contents(self):
+        """История для запроса: список types.Content (краткое содержание старых реплик + реплики).
+        
+        Подряд идущие реплики одной роли (склеенный ход) объединяются в один Content.
+        История всегда начинается с user: ответы модели, чей вопрос уже вытеснен, пропускаются.
+        """
+        contents = []
+        if self.summary:
+            summary_part = types.Part(text=f"[Краткое содержание более раннего разговора]\n{self.summary}")
+            contents.append(types.Content(role="user", parts=[summary_part]))
+        for turn in self.turns:
+            if not contents and turn.role != Turn.USER:
+                continue
+            api_role = Turn.API_ROLES[turn.role]
+            part = types.Part(text=turn.content)
+            if contents and contents[-1].role == api_role:
+                contents[-1].parts.append(part)
+            else:
+                contents.append(types.Content(role=api_role, parts=[part]))
+        return contents
+    
+    def fingerprint(self, turns, skip=0):
+        """Хэш последних turns реплик, не считая skip самых новых (по готовым Turn.hash)"""
+        end = len(self.turns) - skip
+        start = max(0, end - turns)
+        return hash(tuple(self.turns[index].hash for index in range(start, end)))
+    
+    def history_hash(self):
+        """Хэш всего, что уходит в модель: краткое содержание и все реплики"""
+        return hash((self.summary, self.fingerprint(len(self.turns))))
+    
+    def ends_with_user(self, parts):
+        """Последние реплики — ровно эти сообщения пользователя (еще без ответа)"""
+        if not parts or len(parts) > len(self.turns):
+            return False
+        tail = list(self.turns)[-len(parts):]
+        return all(turn.role == Turn.USER and turn.content == part for turn, part in zip(tail, parts))
+    
+    def __len__(self):
+        return len(self.turns)
+    
+    def approx_size(self):
+        """Грубая оценка занимаемой памяти в байтах (для бюджета состояния)"""
+        size = sys.getsizeof(self.turns) + sys.getsizeof(self.summary)
+        for turn in self.turns:
+            # Turn с четырьмя слотами ~64 байта + строка (общая для одинаковых реплик, считаем с запасом)
+            size += 72 + sys.getsizeof(turn.content)
+        return size
+    
+    def export(self):
+        """Состояние для сохранения: {"summary": ..., "summary_tokens": ..., "turns": [[role, content, tokens], ...]}"""
+        return {
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+            "turns": [[turn.role_name, turn.content, turn.tokens] for turn in self.turns],
+        }
+    
+    @classmethod
+    def restore(cls, state):
+        """Обратная операция к export; принимает и просто список реплик [role, content(, tokens)]"""
+        conversation = cls()
+        if isinstance(state, dict):
+            if state.get("summary"):
+                conversation.set_summary(state["summary"], state.get("summary_tokens"))
+            state = state.get("turns", [])
+        for turn in state:
+            conversation.append(*turn)
+        return conversation
+
+# Область диалога по умолчанию, если в настройках чата не задана своя:
+# user — один диалог пользователя во всех чатах, chat — общий диалог чата,
+# chat_user — отдельный диалог каждого пользователя в каждом чате
+CONVERSATION_SCOPE = os.getenv("CONVERSATION_SCOPE", "user")
+
+def conversation_key(user_id, telegram_chat_id, chat_settings=None):
+    """Ключ диалога в user_conversations с учетом области из настроек чата.
+    
+    В личном чате все области совпадают, поэтому ключ там всегда user_id.
+    """
+    if telegram_chat_id is None or telegram_chat_id == user_id:
+        return user_id
+    scope = getattr(chat_settings, "conversation_scope", None) or CONVERSATION_SCOPE
+    if scope == "chat":
+        return ("chat", telegram_chat_id)
+    if scope == "chat_user":
+        return (telegram_chat_id, user_id)
+    return user_id
+
+def get_conversation(key):
+    """Диалог по ключу: из памяти, из выгрузки на диске или новый (вызывать под locks[key])"""
+    conversation = user_conversations.get(key)
+    if conversation is None:
+        conversation = conversation_spill.load(key) if conversation_spill else None
+        if conversation is None:
+            conversation = Conversation()
+        user_conversations[key] = conversation
+    return conversation
+
+def _needs_hydration(key, telegram_chat_id):
+    """Контекст восстанавливаем из БД только для диалога целого чата (личный чат или область chat),
+    которого нет ни в памяти, ни в выгрузке"""
+    return (
+        HISTORY_HYDRATE
+        and DATABASE_INTEGRATION_ENABLED
+        and telegram_chat_id is not None
+        and key in (telegram_chat_id, ("chat", telegram_chat_id))
+        and key not in user_conversations
+        and not (conversation_spill and conversation_spill.exists(key))
+    )
+
+def _install_history(key, history):
+    # Очищаем и оцениваем токены до блокировки; точный подсчет по API на каждую реплику не нужен
+    turns = []
+    for role, content in history:
+        clean_content = sanitize_user_message(content)
+        turns.append((role, clean_content, approx_token_counter.count(clean_content)))
+    with locks[key]:
+        # Пока шел запрос, диалог мог появиться (например, после /clear)
+        if key in user_conversations:
+            return
+        user_conversations[key] = Conversation.restore(turns)
+    logger.info(f"Восстановлено {len(history)} реплик из БД для диалога {key}")
+
+def hydrate_conversation(key, telegram_chat_id):
+    """Подгрузить историю чата из таблицы messages одним запросом при первом обращении"""
+    if not _needs_hydration(key, telegram_chat_id):
+        return
+    try:
+        history = run_async(bot_db.load_conversation_history(telegram_chat_id, MAX_HISTORY))
+    except Exception as e:
+        logger.error(f"Ошибка загрузки истории из БД: {e}")
+        return
+    _install_history(key, history)
+
+async def hydrate_conversation_async(key, telegram_chat_id):
+    """Асинхронный вариант hydrate_conversation для asyncio-режима"""
+    if not _needs_hydration(key, telegram_chat_id):
+        return
+    try:
+        history = await bot_db.load_conversation_history(telegram_chat_id, MAX_HISTORY)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки истории из БД: {e}")
+        return
+    _install_history(key, history)
+
+class HistorySummarizer:
+    """Фоновое сжатие вытесненных реплик в краткое содержание диалога.
+    
+    schedule(key) только ставит диалог в очередь; запрос к модели идет
+    в отдельном потоке, вне пути ответа и без блокировки пользователя.
+    Если за время запроса диалог очистили (/clear) или вытеснили, результат
+    отбрасывается.
+    """
+    
+    PROMPT = (
+        "Ниже краткое содержание начала диалога и следующие за ним реплики. "
+        "Обнови краткое содержание: сохрани факты о собеседнике, договоренности "
+        "и темы, опусти приветствия и шутки. Пиши от третьего лица, не длиннее "
+        "{max_words} слов, без вступлений.\n\n"
+        "Краткое содержание:\n{summary}\n\nРеплики:\n{turns}"
+    )
+    
+    LABELS = {"user": "Собеседник", "assistant": "Кирилл"}
+    
+    def __init__(self, model, min_turns, max_words=150):
+        self.model = model
+        self.min_turns = min_turns
+        self.max_words = max_words
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._scheduled_lock = threading.Lock()
+        self._thread = None
+        self.completed = 0
+        self.failed = 0
+    
+    def schedule(self, key, conversation):
+        """Поставить диалог в очередь, если вытесненных реплик накопилось достаточно"""
+        if len(conversation.evicted) < self.min_turns:
+            return
+        with self._scheduled_lock:
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="history-summarizer", daemon=True)
+                self._thread.start()
+        self._queue.put(key)
+    
+    def _worker(self):
+        while True:
+            key = self._queue.get()
+            with self._scheduled_lock:
+                self._scheduled.discard(key)
+            try:
+                self._summarize(key)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка сжатия истории: {e}")
+    
+    def _summarize(self, key):
+        with locks[key]:
+            conversation = user_conversations.get(key)
+            if conversation is None or not conversation.evicted:
+                return
+            summary = conversation.summary
+            evicted = conversation.take_evicted()
+        
+        turns_text = "".join(f"{self.LABELS[role]}: {content}\n" for role, content in evicted)
+        prompt = self.PROMPT.format(max_words=self.max_words, summary=summary or "(пока пусто)", turns=turns_text)
+        try:
+            response = client.models.generate_content(
+                model=self.model,
+                contents=prompt,
+                config={"temperature": 0.2, "max_output_tokens": self.max_words * 3}
+            )
+            new_summary = sanitize_user_message(response.text or "")
+        except Exception:
+            # Возвращаем реплики, чтобы сжать их при следующей попытке
+            with locks[key]:
+                if user_conversations.get(key) is conversation:
+                    conversation.evicted[:0] = evicted
+            raise
+        if not new_summary:
+            return
+        
+        tokens = token_counter.count(new_summary)
+        with locks[key]:
+            if user_conversations.get(key) is not conversation:
+                return
+            conversation.set_summary(new_summary, tokens)
+            user_conversations.touch(key)
+        self.completed += 1
+    
+    def stats(self):
+        return {"queued": self._queue.qsize(), "completed": self.completed, "failed": self.failed}
+
+history_summarizer = HistorySummarizer(SUMMARY_MODEL, SUMMARY_MIN_TURNS) if SUMMARY_ENABLED else None
+
+# Снимок состояния в памяти для быстрого перезапуска (пусто — выключено)
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "")
+STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", "300"))  # секунды
+
+class StateSnapshotter:
+    """Периодический и финальный снимок диалогов, rate limit и конфигов чатов в один файл.
+    
+    Формат: MAGIC + версия + pickle. Файл пишется во временный и атомарно
+    заменяется, а при старте читается целиком одним чтением. При изменении
+    формата состояния VERSION увеличивается, и старый снимок просто
+    игнорируется. Файл читает только сам бот — pickle из чужих рук не грузим.
+    """
+    
+    MAGIC = b"KGPTSNAP"
+    VERSION = 2
+    
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+    
+    def _collect(self):
+        conversations = []
+        for key, conversation in user_conversations.items():
+            # Диалог могут дописывать в этот момент — копируем под его блокировкой
+            with locks[key]:
+                conversations.append((key, conversation.export()))
+        
+        chat_configs = []
+        for key, cached in chat_settings_cache.items():
+            if cached[2]:
+                continue  # отметки об ошибках загрузки после перезапуска не нужны
+            try:
+                pickle.dumps(cached)
+            except Exception:
+                continue
+            chat_configs.append((key, cached))
+        
+        return {
+            "conversations": conversations,
+            "rate_limits": last_message_time.items(),
+            "chat_configs": chat_configs,
+        }
+    
+    def save(self):
+        started = time.monotonic()
+        data = self.MAGIC + bytes([self.VERSION]) + pickle.dumps(self._collect(), protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info(f"Снимок состояния сохранен: {len(data)} байт за {time.monotonic() - started:.2f}с")
+    
+    def load(self):
+        """Восстановить состояние из снимка; возвращает число восстановленных диалогов"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        
+        header = self.MAGIC + bytes([self.VERSION])
+        if not data.startswith(header):
+            logger.warning("Снимок состояния другой версии — пропускаем")
+            return 0
+        try:
+            state = pickle.loads(data[len(header):])
+        except Exception as e:
+            logger.error(f"Не удалось прочитать снимок состояния: {e}")
+            return 0
+        
+        for key, exported in state["conversations"]:
+            user_conversations[key] = Conversation.restore(exported)
+        for key, timestamp in state["rate_limits"]:
+            last_message_time[key] = timestamp
+        # Пока бот не работал, конфиги могли поменять в админке, а события об этом
+        # не дошли — восстанавливаем их устаревшими: первое сообщение получит
+        # сохраненный конфиг, а свежий загрузится в фоне
+        stale_at = time.time() - CACHE_TTL
+        with settings_cache_lock:
+            for key, (config_data, loaded_at, failed) in state["chat_configs"]:
+                if stale_at - loaded_at < CONFIG_STALE_GRACE:
+                    chat_settings_cache[key] = (config_data, min(loaded_at, stale_at), failed)
+        
+        logger.info(f"Состояние восстановлено из снимка: {len(state['conversations'])} диалогов")
+        return len(state["conversations"])
+    
+    def start(self):
+        """Запустить периодическое сохранение"""
+        self._thread = threading.Thread(target=self._run, name="state-snapshot", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка состояния: {e}")
+    
+    def stop(self):
+        """Остановить периодическое сохранение и сделать финальный снимок"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.save()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения снимка состояния: {e}")
+
+state_snapshots = StateSnapshotter(STATE_SNAPSHOT_PATH, STATE_SNAPSHOT_INTERVAL) if STATE_SNAPSHOT_PATH else None
+
 def is_rate_limited(user_id):
     """Проверка rate limiting"""
     now = time.time()
-    if user_id in last_message_time:
-        if now - last_message_time[user_id] < RATE_WINDOW:
-            return True
+    last_time = last_message_time.get(user_id)
+    if last_time is not None and now - last_time < RATE_WINDOW:
+        return True
     last_message_time[user_id] = now
     return False
 
@@ -226,35 +1140,227 @@ def _safe_to_primitive(obj):
     except Exception as e:
         return f"<unserializable: {e}>"
 
+class SingleFlight:
+    """Одна загрузка на ключ: параллельные вызовы с тем же ключом ждут результат первого.
+    
+    Ожидание идет через concurrent.futures.Future, поэтому ведущим и
+    ожидающими могут быть и потоки, и корутины (do / do_async) вперемешку.
+    Вызовы с другими ключами друг друга не ждут.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+    
+    def _begin(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+            return future, True
+    
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+    
+    def join(self, key):
+        """Future уже идущего вызова с этим ключом или None (сам вызов не начинается)"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+            return future
+    
+    def do(self, key, func, *args):
+        future, leader = self._begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+    
+    async def do_async(self, key, func, *args):
+        """То же для корутинной функции func"""
+        future, leader = self._begin(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func(*args)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+# Загрузки конфигов чатов: одна на чат, другие чаты не ждут
+config_loads = SingleFlight()
+config_refresh_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="config-refresh")
+_config_refresh_tasks = set()
+
+def _lookup_chat_config(telegram_chat_id, now):
+    """Конфиг из кэша: (данные, свежие ли) или (None, False), если его нет или он слишком старый"""
+    cached = chat_settings_cache.get(telegram_chat_id)
+    if cached is None:
+        return None, False
+    config_data, loaded_at, failed = cached
+    age = now - loaded_at
+    if failed and age < CONFIG_ERROR_TTL:
+        # Загрузка недавно не удалась — не идем в БД за этим чатом до конца паузы
+        return config_data, True
+    if failed:
+        return config_data, False
+    if age < CACHE_TTL:
+        return config_data, True
+    if age < CACHE_TTL + CONFIG_STALE_GRACE:
+        return config_data, False
+    return None, False
+
+def _store_chat_config(telegram_chat_id, config_data, generation, failed=False):
+    """Запись кэша — (данные, время загрузки, загрузка не удалась)"""
+    with settings_cache_lock:
+        # Пока шла загрузка, пришло событие изменения — эти данные могут быть уже старыми
+        if generation == config_generation:
+            chat_settings_cache[telegram_chat_id] = (config_data, time.time(), failed)
+
+def _store_config_error(telegram_chat_id, generation):
+    """Отметить ошибку загрузки: следующие CONFIG_ERROR_TTL секунд за этим чатом в БД не ходим.
+    
+    Отметка ставится заново после каждой неудачной попытки, поэтому лежащая БД
+    получает не больше одного запроса на чат за CONFIG_ERROR_TTL. Рабочий
+    конфиг, если он был, продолжает отдаваться, иначе — пустой.
+    """
+    cached = chat_settings_cache.get(telegram_chat_id)
+    config_data = cached[0] if cached is not None else (None, None)
+    _store_chat_config(telegram_chat_id, config_data, generation, failed=True)
+
+def _current_generation():
+    with settings_cache_lock:
+        return config_generation
+
+def _load_chat_config(telegram_chat_id):
+    """Загрузить конфиг чата из БД и положить в кэш.
+    
+    Чат без настроек тоже кэшируется — как (None, пресет по умолчанию),
+    чтобы не ходить за ним в БД на каждое сообщение.
+    """
+    generation = _current_generation()
+    try:
+        chat_settings, active_preset = run_async(bot_db.get_effective_config(telegram_chat_id))
+    except Exception:
+        _store_config_error(telegram_chat_id, generation)
+        raise
+    config_data = (chat_settings, active_preset)
+    _store_chat_config(telegram_chat_id, config_data, generation)
+    logger.info(f"Loaded config for chat {telegram_chat_id}: preset={active_preset.name if active_preset else 'default'}")
+    return config_data
+
+async def _load_chat_config_async(telegram_chat_id):
+    """Асинхронный вариант _load_chat_config (запросы к БД на цикле событий)"""
+    generation = _current_generation()
+    try:
+        chat_settings, active_preset = await bot_db.get_effective_config(telegram_chat_id)
+    except Exception:
+        _store_config_error(telegram_chat_id, generation)
+        raise
+    config_data = (chat_settings, active_preset)
+    _store_chat_config(telegram_chat_id, config_data, generation)
+    logger.info(f"Loaded config for chat {telegram_chat_id}: preset={active_preset.name if active_preset else 'default'}")
+    return config_data
+
+def _refresh_chat_config(telegram_chat_id):
+    try:
+        config_loads.do(telegram_chat_id, _load_chat_config, telegram_chat_id)
+    except Exception as e:
+        logger.error(f"Error refreshing chat config: {e}")
+
+async def _refresh_chat_config_async(telegram_chat_id):
+    try:
+        await config_loads.do_async(telegram_chat_id, _load_chat_config_async, telegram_chat_id)
+    except Exception as e:
+        logger.error(f"Error refreshing chat config: {e}")
+
+def invalidate_chat_configs(event):
+    """Сбросить из кэша конфиги, затронутые событием изменения из админки.
+    
+    chat — настройки одного чата; preset — чаты с этим пресетом и чаты на
+    пресете по умолчанию (он мог смениться вместе с изменением пресета).
+    """
+    global config_generation
+    with settings_cache_lock:
+        config_generation += 1
+        if event.get("type") == "chat":
+            chat_settings_cache.pop(event.get("telegram_chat_id"))
+            return
+        if event.get("type") != "preset":
+            return
+        bot_db.invalidate_default_preset()
+        preset_id = event.get("preset_id")
+        for key, (config_data, _, _) in chat_settings_cache.items():
+            chat_settings, active_preset = config_data
+            uses_default = chat_settings is None or chat_settings.preset_id is None
+            if uses_default or (active_preset is not None and str(active_preset.id) == preset_id):
+                chat_settings_cache.pop(key)
+    logger.info(f"Кэш конфигов сброшен по событию {event}")
+
 def get_chat_config(telegram_chat_id):
-    """Получить настройки чата с кэшированием"""
+    """Получить настройки чата с кэшированием.
+    
+    Устаревший конфиг отдается сразу и обновляется в фоне; при промахе
+    загрузка идет одна на чат, остальные запросы того же чата ее ждут.
+    """
     if not DATABASE_INTEGRATION_ENABLED:
         return None, None
-        
-    with settings_cache_lock:
-        now = time.time()
-        cache_key = telegram_chat_id
-        
-        # Проверяем кэш
-        if cache_key in chat_settings_cache:
-            cached_data, timestamp = chat_settings_cache[cache_key]
-            if now - timestamp < CACHE_TTL:
-                return cached_data
-                
-        # Загружаем из БД
-        try:
-            chat_settings = run_async(bot_db.get_chat_settings(telegram_chat_id))
-            active_preset = run_async(bot_db.get_active_preset(telegram_chat_id))
-            
-            config_data = (chat_settings, active_preset)
-            chat_settings_cache[cache_key] = (config_data, now)
-            
-            logger.info(f"Loaded config for chat {telegram_chat_id}: preset={active_preset.name if active_preset else 'default'}")
-            return config_data
-            
-        except Exception as e:
-            logger.error(f"Error loading chat config: {e}")
-            return None, None
+    
+    config_data, fresh = _lookup_chat_config(telegram_chat_id, time.time())
+    if config_data is not None:
+        if not fresh and not config_loads.in_flight(telegram_chat_id):
+            config_refresh_pool.submit(_refresh_chat_config, telegram_chat_id)
+        return config_data
+    
+    try:
+        return config_loads.do(telegram_chat_id, _load_chat_config, telegram_chat_id)
+    except Exception as e:
+        logger.error(f"Error loading chat config: {e}")
+        return None, None
+
+async def get_chat_config_async(telegram_chat_id):
+    """Асинхронный вариант get_chat_config для asyncio-режима (запросы к БД на том же цикле)"""
+    if not DATABASE_INTEGRATION_ENABLED:
+        return None, None
+    
+    config_data, fresh = _lookup_chat_config(telegram_chat_id, time.time())
+    if config_data is not None:
+        if not fresh and not config_loads.in_flight(telegram_chat_id):
+            task = asyncio.create_task(_refresh_chat_config_async(telegram_chat_id))
+            _config_refresh_tasks.add(task)
+            task.add_done_callback(_config_refresh_tasks.discard)
+        return config_data
+    
+    try:
+        return await config_loads.do_async(telegram_chat_id, _load_chat_config_async, telegram_chat_id)
+    except Exception as e:
+        logger.error(f"Error loading chat config: {e}")
+        return None, None
+
+EMPTY_RESPONSE_TEXT = "Что-то я сегодня молчун... ну ты понял."
+
+class PartialResponse(str):
+    """Текст ответа, поток которого оборвался на середине (в кэш такой не кладем)"""
 
 def extract_text_from_response(response):
     """Извлекает только текст ответа из Google AI response."""
@@ -286,108 +1392,654 @@ def extract_text_from_response(response):
         logger.error(f"Ошибка извлечения текста: {e}")
     
     # Fallback
-    return "Что-то я сегодня молчун... ну ты понял."
+    return EMPTY_RESPONSE_TEXT
 
-class KirillGPT:
-    def __init__(self):
-        self.model = "gemini-2.0-flash-exp"
-        
-    def get_response(self, user_id, message, telegram_chat_id=None):
-        """Получить ответ от Кирилла GPT с учетом пресетов из БД"""
-        try:
-            # Проверяем rate limiting
-            if is_rate_limited(user_id):
-                return "Полегче на поворотах! Не спеши так. Всё сказал?"
-            
-            # Очищаем сообщение от потенциальных атак
-            sanitized_message = sanitize_user_message(message)
-            if not sanitized_message:
-                return "Что, молчишь? Ну ты понял..."
-                
-            # Загружаем настройки чата и активный пресет
-            chat_settings, active_preset = get_chat_config(telegram_chat_id)
+# Ответы Кирилла при ошибках генерации
+ERROR_RESPONSES = [
+    "Блин, у меня мозги сегодня не работают... ну ты понял.",
+    "Что-то я туплю, попробуй ещё раз — всё сказал?",
+    "Ага, технические проблемы... как всегда не вовремя.",
+    "Сейчас думалка подвисла, дай секунду."
+]
+
+# Кэширование системного промпта на стороне Gemini (client.caches); модель должна поддерживать кэш
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "0") != "0"
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))  # секунды
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))  # короче кэш не создается API
+CONTEXT_CACHE_RETRY = 600  # через сколько секунд повторить после неудачного создания
+
+class PromptCacheManager:
+    """Явные кэши Gemini (cached contents) с системным промптом пресета.
+    
+    Запись хранится на пару (модель, пресет) вместе с хэшем промпта: если
+    пресет изменили (PresetService.update_preset) и бот загрузил новую
+    версию, старый кэш удаляется и создается новый. За CONTEXT_CACHE_TTL/4
+    до истечения TTL продлевается в фоне. Если кэш создать не удалось,
+    запросы идут с промптом inline, а повторная попытка — не раньше чем
+    через CONTEXT_CACHE_RETRY секунд.
+    """
+    
+    def __init__(self, client, ttl=CONTEXT_CACHE_TTL, min_tokens=CONTEXT_CACHE_MIN_TOKENS):
+        self.client = client
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self._entries = {}  # (model, preset_key) -> dict(prompt_hash, name, expires_at, retry_at, refreshing)
+        self._lock = threading.Lock()
+        self._creations = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+    
+    @staticmethod
+    def _prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode()).hexdigest()
+    
+    def apply(self, request, preset_key):
+        """Вернуть копию запроса с cached_content вместо system_instruction или None (промпт inline)"""
+        config = request["config"]
+        prompt = config.get("system_instruction")
+        if not prompt:
+            return None
+        
+        name = self._cache_name(request["model"], preset_key, prompt)
+        with self._lock:
+            if name is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if name is None:
+            return None
+        
+        cached_config = {k: v for k, v in config.items() if k != "system_instruction"}
+        cached_config["cached_content"] = name
+        return {**request, "config": cached_config}
+    
+    def _cache_name(self, model, preset_key, prompt):
+        key = (model, preset_key)
+        prompt_hash = self._prompt_hash(prompt)
+        known, name = self._lookup(key, prompt_hash)
+        if known:
+            return name
+        # Кэш создает один вызов на пару (модель, пресет), остальные ждут его результат:
+        # лишние кэши остались бы висеть и оплачиваться до конца TTL
+        return self._creations.do((key, prompt_hash), self._create, key, prompt, prompt_hash)
+    
+    def _lookup(self, key, prompt_hash):
+        """(известен ли ответ, имя кэша или None); запись для старого промпта удаляется"""
+        now = time.time()
+        stale_name = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["prompt_hash"] == prompt_hash:
+                if entry["name"] is None:
+                    if now < entry["retry_at"]:
+                        return True, None
+                elif now < entry["expires_at"]:
+                    if entry["expires_at"] - now < self.ttl / 4 and not entry["refreshing"]:
+                        entry["refreshing"] = True
+                        threading.Thread(target=self._refresh, args=(key, entry), daemon=True).start()
+                    return True, entry["name"]
+            elif entry:
+                # Промпт пресета изменился — старый кэш больше не нужен
+                stale_name = entry["name"]
+            self._entries.pop(key, None)
+        
+        if stale_name:
+            self._delete(stale_name)
+        return False, None
+    
+    def _create(self, key, prompt, prompt_hash):
+        # Предыдущий создатель мог закончить, пока мы шли сюда
+        known, name = self._lookup(key, prompt_hash)
+        if known:
+            return name
+        
+        model, preset_key = key
+        now = time.time()
+        if token_counter.count(prompt) < self.min_tokens:
+            # Слишком короткий промпт API не кэширует — не пробуем, пока промпт не сменится
+            with self._lock:
+                self._entries[key] = {"prompt_hash": prompt_hash, "name": None,
+                                      "expires_at": 0, "retry_at": float("inf"), "refreshing": False}
+            return None
+        
+        try:
+            cache = self.client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=prompt,
+                    display_name=f"kirillgpt-{preset_key or 'default'}",
+                    ttl=f"{self.ttl}s",
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Context cache creation failed, using inline prompt: {e}")
+            with self._lock:
+                self.failures += 1
+                self._entries[key] = {"prompt_hash": prompt_hash, "name": None,
+                                      "expires_at": 0, "retry_at": now + CONTEXT_CACHE_RETRY, "refreshing": False}
+            return None
+        
+        logger.info(f"Created context cache {cache.name} for preset {preset_key or 'default'}")
+        with self._lock:
+            self._entries[key] = {"prompt_hash": prompt_hash, "name": cache.name,
+                                  "expires_at": now + self.ttl, "retry_at": 0, "refreshing": False}
+        return cache.name
+    
+    def _refresh(self, key, entry):
+        try:
+            self.client.caches.update(name=entry["name"], config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+            with self._lock:
+                entry["expires_at"] = time.time() + self.ttl
+        except Exception as e:
+            logger.warning(f"Context cache refresh failed: {e}")
+            self.invalidate(key[1], model=key[0])
+        finally:
+            with self._lock:
+                entry["refreshing"] = False
+    
+    def _delete(self, name):
+        try:
+            self.client.caches.delete(name=name)
+        except Exception as e:
+            logger.warning(f"Context cache delete failed: {e}")
+    
+    def invalidate(self, preset_key, model=None):
+        """Забыть кэши пресета (например, после ошибки запроса с cached_content)"""
+        with self._lock:
+            keys = [key for key in self._entries if key[1] == preset_key and (model is None or key[0] == model)]
+            names = [self._entries.pop(key)["name"] for key in keys]
+        for name in names:
+            if name:
+                self._delete(name)
+    
+    def stats(self):
+        with self._lock:
+            active = sum(1 for entry in self._entries.values() if entry["name"])
+            return {"active": active, "hits": self.hits, "misses": self.misses, "failures": self.failures}
+
+context_cache = PromptCacheManager(client) if CONTEXT_CACHE_ENABLED else None
+
+def preset_cache_key(chat_config):
+    """Ключ пресета для кэша контекста (None — промпт по умолчанию)"""
+    _, active_preset = chat_config
+    return str(active_preset.id) if active_preset else None
+
+# Кэш ответов на точные повторы (включается в пресете флагом response_cache_enabled)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))  # секунды
+RESPONSE_CACHE_BYPASS = float(os.getenv("RESPONSE_CACHE_BYPASS", "0.2"))  # доля запросов мимо кэша, ради разнообразия
+RESPONSE_CACHE_HISTORY_TURNS = int(os.getenv("RESPONSE_CACHE_HISTORY_TURNS", "1"))  # сколько предыдущих реплик входит в ключ
+
+def normalize_prompt_text(parts):
+    """Текст хода для сравнения: без регистра, лишних пробелов и хвостовой пунктуации"""
+    text = " ".join(" ".join(part.lower().split()) for part in parts)
+    return text.rstrip("!?.,;:)( ")
+
+def preset_version(active_preset):
+    """Версия пресета: меняется при каждом сохранении в админке"""
+    updated_at = getattr(active_preset, "updated_at", None)
+    return f"{active_preset.id}:{updated_at.timestamp() if updated_at else ''}"
+
+class ResponseCache:
+    """Кэш ответов модели на точно повторяющиеся реплики ("привет", "кто ты?").
+    
+    Ключ — версия пресета, отпечаток нескольких предыдущих реплик и
+    нормализованный текст хода. Записи живут RESPONSE_CACHE_TTL секунд с
+    момента ответа, размер ограничен LRU. С вероятностью bypass_probability
+    кэш пропускается, и новый ответ модели заменяет старый — так персонаж
+    не повторяется слово в слово.
+    """
+    
+    def __init__(self, max_entries, ttl, bypass_probability):
+        self.name = "response_cache"
+        self.ttl = ttl
+        self.bypass_probability = bypass_probability
+        self._entries = BoundedStateMap("response_cache", max_entries=max_entries, idle_ttl=ttl)
+        self._lock = threading.Lock()  # счетчики меняют потоки полос и цикл событий
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+    
+    def lookup(self, key):
+        """Готовый ответ или None (промах, устаревшая запись или случайный обход)"""
+        if random.random() < self.bypass_probability:
+            with self._lock:
+                self.bypassed += 1
+            return None
+        cached = self._entries.get(key)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            with self._lock:
+                self.hits += 1
+            return cached[0]
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def store(self, key, response):
+        if not response or isinstance(response, PartialResponse) or response == EMPTY_RESPONSE_TEXT:
+            return
+        self._entries[key] = (response, time.time())
+    
+    def stats(self):
+        with self._lock:
+            hits, misses, bypassed = self.hits, self.misses, self.bypassed
+        lookups = hits + misses
+        return {
+            "entries": len(self._entries),
+            "hits": hits,
+            "misses": misses,
+            "bypassed": bypassed,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_BYPASS) if RESPONSE_CACHE_SIZE > 0 else None
+
+# Склейка одинаковых одновременных запросов к модели в одном диалоге (один вызов на
+# несколько одинаковых "ахах" в общем диалоге чата, conversation_scope=chat).
+# Срабатывает, только если сообщения одного чата обрабатываются параллельно:
+# BOT_RUNTIME=asyncio или WORKER_LANES=0. Полоса чата выполняет их по очереди,
+# и к приходу второго сообщения первый запрос уже завершен. Разные диалоги
+# (область user или chat_user) не склеиваются — у них разная история
+GENERATION_COALESCING = os.getenv("GENERATION_COALESCING", "0") == "1"
+generation_flights = SingleFlight() if GENERATION_COALESCING else None
+
+# Как часто писать счетчики состояния в лог, секунды (0 — не писать)
+STATS_LOG_INTERVAL = float(os.getenv("STATS_LOG_INTERVAL", "600"))
+
+def state_stats():
+    """Счетчики всех ограниченных хранилищ состояния и фоновых кэшей"""
+    stats = {
+        state.name: state.stats()
+        for state in (user_conversations, locks, last_message_time, chat_settings_cache, response_cache)
+        if state is not None
+    }
+    if history_summarizer is not None:
+        stats["summarizer"] = history_summarizer.stats()
+    if context_cache is not None:
+        stats["context_cache"] = context_cache.stats()
+    if lane_dispatcher is not None:
+        stats["lanes"] = lane_dispatcher.depths()
+    if DATABASE_INTEGRATION_ENABLED:
+        stats["identities"] = bot_db.identity_stats()
+    if DATABASE_INTEGRATION_ENABLED and WRITE_BEHIND_ENABLED:
+        stats["write_queue"] = message_writer.stats()
+    return stats
+
+class StatsReporter:
+    """Периодически пишет state_stats() одной строкой в лог и чистит старые выгрузки диалогов"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="state-stats", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                logger.info(f"Состояние: {json.dumps(state_stats(), default=str)}")
+            except Exception as e:
+                logger.error(f"Ошибка сбора счетчиков состояния: {e}")
+            if conversation_spill is not None:
+                try:
+                    removed = conversation_spill.sweep(STATE_SPILL_TTL)
+                    if removed:
+                        logger.info(f"Удалено старых выгрузок диалогов: {removed}")
+                except OSError as e:
+                    logger.error(f"Ошибка очистки выгрузок диалогов: {e}")
+    
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+stats_reporter = StatsReporter(STATS_LOG_INTERVAL) if STATS_LOG_INTERVAL > 0 else None
+
+class KirillGPT:
+    def __init__(self):
+        self.model = TEXT_MODEL
+        self.image_model = 'imagen-3.0-generate-002'
+        self.max_retries = 3
+    
+    def _accept_turn(self, user_id, message):
+        """Rate limiting и очистка хода.
+        
+        Возвращает (готовый_ответ, None), если до модели дело не дойдет,
+        или (None, очищенные сообщения хода).
+        """
+        # Проверяем rate limiting
+        if is_rate_limited(user_id):
+            return "Полегче на поворотах! Не спеши так. Всё сказал?", None
+        
+        # Очищаем сообщения от потенциальных атак (склеенный ход — несколько сообщений подряд)
+        parts = message if isinstance(message, (list, tuple)) else [message]
+        sanitized_parts = [part for part in map(sanitize_user_message, parts) if part]
+        if not sanitized_parts:
+            return "Что, молчишь? Ну ты понял...", None
+        return None, sanitized_parts
+    
+    def _prepare_request(self, key, sanitized_parts, part_tokens, chat_config):
+        """Подготовить запрос к модели.
+        
+        key — ключ диалога (conversation_key), part_tokens — заранее посчитанные
+        токены сообщений хода (у GeminiTokenCounter это запрос к API, его нельзя
+        делать под блокировкой и в цикле событий).
+        Возвращает (Future, None, None, None), если такой же запрос по этому диалогу
+        уже выполняется, или (None, kwargs для generate_content, ключ кэша
+        ответов или None, ключ склейки запросов или None).
+        """
+        chat_settings, active_preset = chat_config
+        
+        # Определяем параметры генерации из пресета или значения по умолчанию
+        temperature = float(active_preset.temperature) if active_preset and active_preset.temperature else 0.7
+        max_tokens = int(active_preset.max_tokens) if active_preset and active_preset.max_tokens else 600
+        history_budget = HISTORY_TOKEN_BUDGET
+        if active_preset and getattr(active_preset, "history_token_budget", None) is not None:
+            history_budget = int(active_preset.history_token_budget)
+        
+        # Выбираем системный промпт
+        if active_preset and active_preset.system_prompt_override:
+            system_prompt = active_preset.system_prompt_override
+            logger.info(f"Using custom prompt from preset: {active_preset.name}")
+        else:
+            system_prompt = KIRILL_SYSTEM_PROMPT
+            logger.info("Using default KIRILL_SYSTEM_PROMPT")
             
-            # Определяем параметры генерации из пресета или значения по умолчанию
-            temperature = float(active_preset.temperature) if active_preset and active_preset.temperature else 0.7
-            max_tokens = int(active_preset.max_tokens) if active_preset and active_preset.max_tokens else 600
+        with locks[key]:
+            # Инициализируем историю для нового диалога
+            conversation = get_conversation(key)
             
-            # Выбираем системный промпт
-            if active_preset and active_preset.system_prompt_override:
-                system_prompt = active_preset.system_prompt_override
-                logger.info(f"Using custom prompt from preset: {active_preset.name}")
-            else:
-                system_prompt = KIRILL_SYSTEM_PROMPT
-                logger.info("Using default KIRILL_SYSTEM_PROMPT")
-                
-            with locks[user_id]:
-                # Инициализируем историю для нового пользователя
-                if user_id not in user_conversations:
-                    user_conversations[user_id] = []
-                
-                # Добавляем сообщение пользователя в историю
-                user_conversations[user_id].append({
-                    "role": "user", 
-                    "content": sanitized_message
-                })
-                
-                # Ограничиваем историю
-                if len(user_conversations[user_id]) > MAX_HISTORY:
-                    user_conversations[user_id] = user_conversations[user_id][-MAX_HISTORY:]
-                
-                # Формируем безопасные сообщения как простой текст (Google AI требует строку)
-                conversation_text = f"[SYSTEM INSTRUCTION]\n{system_prompt}\n[END SYSTEM]\n\n"
-                
-                # Добавляем историю диалога
-                for msg in user_conversations[user_id]:
-                    # Дополнительная санитизация для истории
-                    clean_content = sanitize_user_message(msg["content"])
-                    if msg["role"] == "user":
-                        conversation_text += f"User: {clean_content}\n"
-                    else:
-                        conversation_text += f"Assistant: {clean_content}\n"
+            # Тот же текст уже ждет ответа модели — ждем его же, не дублируя реплику в истории
+            if generation_flights and conversation.ends_with_user(sanitized_parts):
+                pending = generation_flights.join(
+                    (preset_version(active_preset) if active_preset else None, key, conversation.history_hash())
+                )
+                if pending is not None:
+                    return pending, None, None, None
             
-            # Генерируем ответ с retry логикой
-            response = None
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = client.models.generate_content(
-                        model=self.model,
-                        contents=conversation_text,
-                        config={
-                            "temperature": temperature,
-                            "max_output_tokens": max_tokens,
-                            "top_p": 0.9
-                        }
-                    )
-                    break
-                except Exception as api_error:
-                    if attempt == max_retries - 1:
-                        raise api_error
-                    time.sleep(2 ** attempt)  # Exponential backoff
+            # Добавляем сообщения пользователя в историю (старые реплики вытесняются сами)
+            for sanitized_message, tokens in zip(sanitized_parts, part_tokens):
+                conversation.append("user", sanitized_message, tokens)
+            conversation.trim_to_budget(history_budget)
+            user_conversations.touch(key)
+            if history_summarizer:
+                history_summarizer.schedule(key, conversation)
             
-            # Используем универсальный парсер ответа
-            ai_response = extract_text_from_response(response)
+            # История — отдельные реплики с ролями; системный промпт — system_instruction
+            contents = conversation.contents()
             
-            # Добавляем ответ в историю
-            with locks[user_id]:
-                user_conversations[user_id].append({
-                    "role": "assistant", 
-                    "content": ai_response
-                })
+            response_cache_key = None
+            if response_cache and active_preset and getattr(active_preset, "response_cache_enabled", False):
+                response_cache_key = (
+                    preset_version(active_preset),
+                    conversation.fingerprint(RESPONSE_CACHE_HISTORY_TURNS, skip=len(sanitized_parts)),
+                    normalize_prompt_text(sanitized_parts),
+                )
             
+            flight_key = None
+            if generation_flights:
+                flight_key = (preset_version(active_preset) if active_preset else None, key, conversation.history_hash())
+        
+        return None, {
+            "model": self.model,
+            "contents": contents,
+            "config": {
+                "system_instruction": system_prompt,
+                "temperature": temperature,
+                "max_output_tokens": max_tokens,
+                "top_p": 0.9
+            }
+        }, response_cache_key, flight_key
+    
+    def _remember_response(self, key, ai_response):
+        """Добавить ответ модели в историю диалога"""
+        # Очищаем один раз при сохранении, а не при каждой сборке промпта
+        clean_response = sanitize_user_message(ai_response)
+        self._append_response(key, clean_response, Conversation.count_tokens(clean_response))
+    
+    async def _remember_response_async(self, key, ai_response):
+        """_remember_response для asyncio-режима: токены считаются без блокировки цикла"""
+        clean_response = sanitize_user_message(ai_response)
+        self._append_response(key, clean_response, await Conversation.count_tokens_async(clean_response))
+    
+    def _append_response(self, key, clean_response, tokens):
+        with locks[key]:
+            get_conversation(key).append("assistant", clean_response, tokens)
+            user_conversations.touch(key)
+    
+    def _generate(self, request, on_partial=None, attempts=None):
+        """Сгенерировать текст ответа с retry логикой.
+        
+        Если передан on_partial, ответ запрашивается потоком (generate_content_stream)
+        и on_partial вызывается с накопленным текстом после каждого чанка.
+        attempts — число попыток (по умолчанию max_retries).
+        """
+        attempts = attempts or self.max_retries
+        for attempt in range(attempts):
+            text = ""
+            try:
+                if on_partial is None:
+                    response = client.models.generate_content(**request)
+                    # Используем универсальный парсер ответа
+                    return extract_text_from_response(response)
+                
+                for chunk in client.models.generate_content_stream(**request):
+                    piece = getattr(chunk, 'text', None)
+                    if piece:
+                        text += piece
+                        on_partial(text)
+                return text.strip() or extract_text_from_response(None)
+            except Exception as api_error:
+                if text:
+                    # Часть ответа уже в чате — повтор дал бы другой текст, оставляем что есть
+                    logger.error(f"Поток ответа оборвался: {api_error}")
+                    return PartialResponse(text.strip())
+                if attempt == attempts - 1:
+                    raise api_error
+                time.sleep(2 ** attempt)  # Exponential backoff
+    
+    async def _generate_async(self, request, on_partial=None, attempts=None):
+        """Асинхронный вариант _generate через client.aio (on_partial — корутина)"""
+        attempts = attempts or self.max_retries
+        for attempt in range(attempts):
+            text = ""
+            try:
+                if on_partial is None:
+                    response = await client.aio.models.generate_content(**request)
+                    return extract_text_from_response(response)
+                
+                async for chunk in await client.aio.models.generate_content_stream(**request):
+                    piece = getattr(chunk, 'text', None)
+                    if piece:
+                        text += piece
+                        await on_partial(text)
+                return text.strip() or extract_text_from_response(None)
+            except Exception as api_error:
+                if text:
+                    logger.error(f"Поток ответа оборвался: {api_error}")
+                    return PartialResponse(text.strip())
+                if attempt == attempts - 1:
+                    raise api_error
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+    
+    def _generate_cached(self, request, preset_key, on_partial=None):
+        """_generate с системным промптом из кэша Gemini; при ошибке кэша — повтор с промптом inline"""
+        cached_request = context_cache.apply(request, preset_key) if context_cache else None
+        if cached_request is None:
+            return self._generate(request, on_partial)
+        try:
+            return self._generate(cached_request, on_partial, attempts=1)
+        except Exception as e:
+            logger.warning(f"Запрос с кэшем контекста не удался, повтор без кэша: {e}")
+            context_cache.invalidate(preset_key, model=request["model"])
+            return self._generate(request, on_partial)
+    
+    async def _generate_cached_async(self, request, preset_key, on_partial=None):
+        """Асинхронный вариант _generate_cached (создание кэша — в потоке, чтобы не блокировать цикл)"""
+        cached_request = await asyncio.to_thread(context_cache.apply, request, preset_key) if context_cache else None
+        if cached_request is None:
+            return await self._generate_async(request, on_partial)
+        try:
+            return await self._generate_async(cached_request, on_partial, attempts=1)
+        except Exception as e:
+            logger.warning(f"Запрос с кэшем контекста не удался, повтор без кэша: {e}")
+            await asyncio.to_thread(context_cache.invalidate, preset_key, request["model"])
+            return await self._generate_async(request, on_partial)
+    
+    def _respond(self, request, preset_key, response_cache_key, on_partial=None):
+        """Ответ модели с учетом кэша ответов"""
+        ai_response = response_cache.lookup(response_cache_key) if response_cache_key else None
+        if ai_response is None:
+            ai_response = self._generate_cached(request, preset_key, on_partial)
+            if response_cache_key:
+                response_cache.store(response_cache_key, ai_response)
+        return ai_response
+    
+    async def _respond_async(self, request, preset_key, response_cache_key, on_partial=None):
+        """Асинхронный вариант _respond"""
+        ai_response = response_cache.lookup(response_cache_key) if response_cache_key else None
+        if ai_response is None:
+            ai_response = await self._generate_cached_async(request, preset_key, on_partial)
+            if response_cache_key:
+                response_cache.store(response_cache_key, ai_response)
+        return ai_response
+    
+    def get_response(self, user_id, message, telegram_chat_id=None, on_partial=None):
+        """Получить ответ от Кирилла GPT с учетом пресетов из БД.
+        
+        message — текст или список текстов склеенного хода: все они попадают
+        в историю и отвечаются одним запросом к модели. on_partial — см. _generate.
+        """
+        try:
+            # Загружаем настройки чата и активный пресет
+            # Rate limit — до любых походов в БД, иначе флуд грузил бы конфиг и историю зря
+            reply, sanitized_parts = self._accept_turn(user_id, message)
+            if reply is not None:
+                return reply
+            chat_config = get_chat_config(telegram_chat_id)
+            key = conversation_key(user_id, telegram_chat_id, chat_config[0])
+            hydrate_conversation(key, telegram_chat_id)
+            # Токены считаем до блокировки: у GeminiTokenCounter это запрос к API
+            part_tokens = [Conversation.count_tokens(part) for part in sanitized_parts]
+            reply, request, response_cache_key, flight_key = self._prepare_request(key, sanitized_parts, part_tokens, chat_config)
+            if request is None:
+                # Ответ на такой же запрос уже генерируется — в историю его запишет тот вызов
+                return reply.result() if isinstance(reply, concurrent.futures.Future) else reply
+            
+            preset_key = preset_cache_key(chat_config)
+            if flight_key is not None:
+                ai_response = generation_flights.do(
+                    flight_key, self._respond, request, preset_key, response_cache_key, on_partial
+                )
+            else:
+                ai_response = self._respond(request, preset_key, response_cache_key, on_partial)
+            self._remember_response(key, ai_response)
             return ai_response
             
         except Exception as e:
             logger.error(f"Ошибка при получении ответа от Google AI: {e}")
             # Возвращаем ответ в стиле Кирилла при ошибке
-            error_responses = [
-                "Блин, у меня мозги сегодня не работают... ну ты понял.",
-                "Что-то я туплю, попробуй ещё раз — всё сказал?",
-                "Ага, технические проблемы... как всегда не вовремя.",
-                "Сейчас думалка подвисла, дай секунду."
-            ]
-            return random.choice(error_responses)
+            return random.choice(ERROR_RESPONSES)
+    
+    async def get_response_async(self, user_id, message, telegram_chat_id=None, on_partial=None):
+        """То же, что get_response, но через client.aio без блокировки цикла событий"""
+        try:
+            reply, sanitized_parts = self._accept_turn(user_id, message)
+            if reply is not None:
+                return reply
+            chat_config = await get_chat_config_async(telegram_chat_id)
+            key = conversation_key(user_id, telegram_chat_id, chat_config[0])
+            await hydrate_conversation_async(key, telegram_chat_id)
+            part_tokens = await asyncio.gather(*(Conversation.count_tokens_async(part) for part in sanitized_parts))
+            reply, request, response_cache_key, flight_key = self._prepare_request(key, sanitized_parts, part_tokens, chat_config)
+            if request is None:
+                if isinstance(reply, concurrent.futures.Future):
+                    return await asyncio.wrap_future(reply)
+                return reply
+            
+            preset_key = preset_cache_key(chat_config)
+            if flight_key is not None:
+                ai_response = await generation_flights.do_async(
+                    flight_key, self._respond_async, request, preset_key, response_cache_key, on_partial
+                )
+            else:
+                ai_response = await self._respond_async(request, preset_key, response_cache_key, on_partial)
+            await self._remember_response_async(key, ai_response)
+            return ai_response
+            
+        except Exception as e:
+            logger.error(f"Ошибка при получении ответа от Google AI: {e}")
+            return random.choice(ERROR_RESPONSES)
+    
+    def _image_prompt(self, description):
+        """Промпт в стиле Дали с козявками"""
+        surreal_prompts = [
+            f"Surrealistic painting in Salvador Dali style: {description}, painted entirely with tiny bugs and insects as brushstrokes, melting time, floating elements, dreamlike landscape, hyperrealistic insects texture, oil painting, museum quality",
+            f"Salvador Dali inspired artwork: {description}, created using thousands of small bugs, ants, and beetles as paint, distorted perspective, impossible geometry, soft watches style, insect mosaic technique",
+            f"Dalí-esque surreal composition: {description}, every element painted with microscopic insects and bugs, floating in dreamscape, persistence of memory style, bug-textured surfaces, golden hour lighting"
+        ]
+        
+        # Случайно выбираем один из промптов
+        return random.choice(surreal_prompts)
+    
+    def _image_request(self, description):
+        """Параметры запроса к Imagen"""
+        return {
+            "model": self.image_model,
+            "prompt": self._image_prompt(description),
+            "config": types.GenerateImagesConfig(
+                number_of_images=1,
+                aspect_ratio="16:9"
+            )
+        }
+    
+    def _image_excuse(self, description):
+        """Специальный ответ Кирилла о проблемах с рисованием"""
+        kirill_excuses = [
+            f"🎨 Слушай, хотел тебе {description} нарисовать в стиле Дали с козявками... \n\n❌ Но проблема: нужно включить биллинг в Google AI Studio (ai.google.dev) для API ключа. \n\n💡 Как исправить:\n1. Зайди на ai.google.dev\n2. Billing → Add credit card\n3. Enable paid usage\n\nПока буду словами рисовать — ну ты понял.",
+            f"🖌️ Эх, {description} бы классный получился в сюрреалистическом стиле... \n\n⚠️ Imagen API требует платного аккаунта Google AI. \n\n🔧 Быстрое решение: ai.google.dev → Settings → Billing → Upgrade. \n\nА пока опишу на пальцах — всё сказал?",
+            f"🎭 Да блин, хочется нарисовать твой {description} козявками как Дали! \n\n🚫 Google говорит: плати, тогда рисуй. \n\n💳 Нужно: Google Cloud billing или AI Studio paid plan. \n\nПока только художественное описание дам — да уж."
+        ]
+        return random.choice(kirill_excuses)
+    
+    def _image_description_request(self, description):
+        """Параметры запроса художественного описания вместо картинки"""
+        return {
+            "model": self.model,
+            "contents": f"Пользователь хочет картинку: '{description}'. Опиши как бы это выглядело в сюрреалистическом стиле Дали с козявками, но коротко и в стиле Кирилла (грубовато, с 'ну ты понял', 'всё сказал?'). Не больше 3-4 предложений.",
+            "config": {
+                "temperature": 0.8,
+                "max_output_tokens": 200
+            }
+        }
+    
+    def _image_result(self, description, response):
+        """Собрать ответ из результата Imagen с характерным комментарием Кирилла"""
+        if response and response.generated_images:
+            # Извлекаем изображение
+            generated_image = response.generated_images[0]
+            if hasattr(generated_image, 'image') and generated_image.image:
+                image_bytes = generated_image.image.image_bytes
+                
+                # Создаем характерный комментарий Кирилла
+                kirill_comments = [
+                    f"Ну вот, нарисовал твой {description}... правда козявками, как ты хотел. Дали бы ещё и не такое нарисовал — всё сказал?",
+                    f"Готово! Твой {description} в стиле Дали, только козявками весь. Ну ты художник... да уж.",
+                    f"Вот тебе {description}, сюрреализм какой-то... всё козявками размазано, как Дали любил. Ну ты понял.",
+                    f"Нарисовал, нарисовал... {description} твой, только странный получился. Дали же, что с него возьмёшь.",
+                    f"Ага, вот тебе {description}! Козявками рисовал, как заказывал. Странная у тебя фантазия... ну да ладно."
+                ]
+                
+                return {
+                    'image': image_bytes,
+                    'comment': random.choice(kirill_comments)
+                }
+        
+        return None
     
     def generate_image(self, user_id, description):
         """Генерация изображения в стиле Дали с козявками"""
@@ -395,56 +2047,21 @@ class KirillGPT:
             # Проверяем rate limiting
             if is_rate_limited(user_id):
                 return None
-                
-            # Создаем промпт в стиле Дали с козявками и характерными комментариями Кирилла
-            surreal_prompts = [
-                f"Surrealistic painting in Salvador Dali style: {description}, painted entirely with tiny bugs and insects as brushstrokes, melting time, floating elements, dreamlike landscape, hyperrealistic insects texture, oil painting, museum quality",
-                f"Salvador Dali inspired artwork: {description}, created using thousands of small bugs, ants, and beetles as paint, distorted perspective, impossible geometry, soft watches style, insect mosaic technique",
-                f"Dalí-esque surreal composition: {description}, every element painted with microscopic insects and bugs, floating in dreamscape, persistence of memory style, bug-textured surfaces, golden hour lighting"
-            ]
-            
-            # Случайно выбираем один из промптов
-            enhanced_prompt = random.choice(surreal_prompts)
             
             # Пытаемся генерировать изображение через Google AI Imagen
             try:
-                response = client.models.generate_images(
-                    model='imagen-3.0-generate-002',
-                    prompt=enhanced_prompt,
-                    config=types.GenerateImagesConfig(
-                        number_of_images=1,
-                        aspect_ratio="16:9"
-                    )
-                )
+                response = client.models.generate_images(**self._image_request(description))
             except Exception as api_error:
                 logger.error(f"Ошибка API генерации изображения: {api_error}")
-                
-                # Специальный ответ Кирилла о проблемах с рисованием
-                kirill_excuses = [
-                    f"🎨 Слушай, хотел тебе {description} нарисовать в стиле Дали с козявками... \n\n❌ Но проблема: нужно включить биллинг в Google AI Studio (ai.google.dev) для API ключа. \n\n💡 Как исправить:\n1. Зайди на ai.google.dev\n2. Billing → Add credit card\n3. Enable paid usage\n\nПока буду словами рисовать — ну ты понял.",
-                    f"🖌️ Эх, {description} бы классный получился в сюрреалистическом стиле... \n\n⚠️ Imagen API требует платного аккаунта Google AI. \n\n🔧 Быстрое решение: ai.google.dev → Settings → Billing → Upgrade. \n\nА пока опишу на пальцах — всё сказал?",
-                    f"🎭 Да блин, хочется нарисовать твой {description} козявками как Дали! \n\n🚫 Google говорит: плати, тогда рисуй. \n\n💳 Нужно: Google Cloud billing или AI Studio paid plan. \n\nПока только художественное описание дам — да уж."
-                ]
-                
-                excuse = random.choice(kirill_excuses)
+                excuse = self._image_excuse(description)
                 
                 # Добавляем художественное описание в стиле Кирилла
                 try:
-                    text_response = client.models.generate_content(
-                        model=self.model,
-                        contents=f"Пользователь хочет картинку: '{description}'. Опиши как бы это выглядело в сюрреалистическом стиле Дали с козявками, но коротко и в стиле Кирилла (грубовато, с 'ну ты понял', 'всё сказал?'). Не больше 3-4 предложений.",
-                        config={
-                            "temperature": 0.8,
-                            "max_output_tokens": 200
-                        }
-                    )
-                    
+                    text_response = client.models.generate_content(**self._image_description_request(description))
                     artistic_description = extract_text_from_response(text_response)
-                    full_response = f"{excuse}\n\nА так бы выглядело: {artistic_description}"
-                    
                     return {
                         'image': None,
-                        'comment': full_response
+                        'comment': f"{excuse}\n\nА так бы выглядело: {artistic_description}"
                     }
                     
                 except Exception as text_error:
@@ -454,29 +2071,40 @@ class KirillGPT:
                         'comment': excuse
                     }
             
-            if response and response.generated_images:
-                # Извлекаем изображение
-                generated_image = response.generated_images[0]
-                if hasattr(generated_image, 'image') and generated_image.image:
-                    image_bytes = generated_image.image.image_bytes
-                    
-                    # Создаем характерный комментарий Кирилла
-                    kirill_comments = [
-                        f"Ну вот, нарисовал твой {description}... правда козявками, как ты хотел. Дали бы ещё и не такое нарисовал — всё сказал?",
-                        f"Готово! Твой {description} в стиле Дали, только козявками весь. Ну ты художник... да уж.",
-                        f"Вот тебе {description}, сюрреализм какой-то... всё козявками размазано, как Дали любил. Ну ты понял.",
-                        f"Нарисовал, нарисовал... {description} твой, только странный получился. Дали же, что с него возьмёшь.",
-                        f"Ага, вот тебе {description}! Козявками рисовал, как заказывал. Странная у тебя фантазия... ну да ладно."
-                    ]
-                    
-                    comment = random.choice(kirill_comments)
+            return self._image_result(description, response)
+            
+        except Exception as e:
+            logger.error(f"Ошибка генерации изображения: {e}")
+            return None
+    
+    async def generate_image_async(self, user_id, description):
+        """Асинхронная генерация изображения через client.aio"""
+        try:
+            if is_rate_limited(user_id):
+                return None
+            
+            try:
+                response = await client.aio.models.generate_images(**self._image_request(description))
+            except Exception as api_error:
+                logger.error(f"Ошибка API генерации изображения: {api_error}")
+                excuse = self._image_excuse(description)
+                
+                try:
+                    text_response = await client.aio.models.generate_content(**self._image_description_request(description))
+                    artistic_description = extract_text_from_response(text_response)
+                    return {
+                        'image': None,
+                        'comment': f"{excuse}\n\nА так бы выглядело: {artistic_description}"
+                    }
                     
+                except Exception as text_error:
+                    logger.error(f"Ошибка описания изображения: {text_error}")
                     return {
-                        'image': image_bytes,
-                        'comment': comment
+                        'image': None,
+                        'comment': excuse
                     }
             
-            return None
+            return self._image_result(description, response)
             
         except Exception as e:
             logger.error(f"Ошибка генерации изображения: {e}")
@@ -485,23 +2113,15 @@ class KirillGPT:
 # Создаем экземпляр Кирилла
 kirill = KirillGPT()
 
-@bot.message_handler(commands=['start'])
-def start_message(message):
-    """Обработчик команды /start"""
-    welcome_text = """Привет! Я — Кирилл GPT. 
+WELCOME_TEXT = """Привет! Я — Кирилл GPT. 
 
 Да уж, не самый умный, но зато честный... ну ты понял.
 
 Можешь спрашивать что хочешь, я постараюсь ответить. Правда, иногда путаюсь в словах — что с меня возьмёшь.
 
 Всё сказал?"""
-    
-    bot.reply_to(message, welcome_text)
 
-@bot.message_handler(commands=['help'])
-def help_message(message):
-    """Обработчик команды /help"""
-    help_text = """Ну что тебе объяснять-то?
+HELP_TEXT = """Ну что тебе объяснять-то?
 
 Просто пиши мне что хочешь, я отвечу как смогу.
 
@@ -512,19 +2132,51 @@ def help_message(message):
 /image <описание> — то же самое, только по-английски
 
 Ага, вот и вся наука — всё сказал?"""
+
+CLEAR_TEXT = "Ну всё, стёр нашу переписку. Начинаем с чистого листа — ну ты понял."
+
+def parse_image_description(text):
+    """Извлечь описание картинки из команды. Возвращает (описание, None) или (None, ответ-отказ)"""
+    command_parts = (text or "").split(' ', 1)
+    if len(command_parts) < 2:
+        return None, "Чё рисовать-то? Скажи что хочешь — котика там или ещё что... всё сказал?"
     
-    bot.reply_to(message, help_text)
+    description = command_parts[1].strip()
+    if not description:
+        return None, "Ну и что рисовать? Пустоту? Я не Малевич... дай тему нормальную."
+    
+    return description, None
+
+def clear_conversation(key):
+    """Удалить историю диалога (key — см. conversation_key)"""
+    user_conversations.pop(key)
+    if conversation_spill:
+        conversation_spill.discard(key)
+
+@bot.message_handler(commands=['start'])
+@in_chat_lane
+def start_message(message):
+    """Обработчик команды /start"""
+    bot.reply_to(message, WELCOME_TEXT)
+
+@bot.message_handler(commands=['help'])
+@in_chat_lane
+def help_message(message):
+    """Обработчик команды /help"""
+    bot.reply_to(message, HELP_TEXT)
 
 @bot.message_handler(commands=['clear'])
+@in_chat_lane
 def clear_history(message):
     """Очистка истории диалога"""
-    user_id = message.from_user.id
-    if user_id in user_conversations:
-        del user_conversations[user_id]
-    
-    bot.reply_to(message, "Ну всё, стёр нашу переписку. Начинаем с чистого листа — ну ты понял.")
+    chat_settings, _ = get_chat_config(message.chat.id)
+    clear_conversation(conversation_key(message.from_user.id, message.chat.id, chat_settings))
+    # Команда в БД — граница, дальше которой история не восстанавливается
+    save_user_message_to_db(message)
+    bot.reply_to(message, CLEAR_TEXT)
 
 @bot.message_handler(commands=['картинка', 'image', 'img'])
+@in_chat_lane
 def generate_image(message):
     """Генерация изображений в стиле Дали с козявками"""
     user_id = message.from_user.id
@@ -535,14 +2187,9 @@ def generate_image(message):
         return
     
     # Извлекаем описание картинки из команды
-    command_parts = message.text.split(' ', 1)
-    if len(command_parts) < 2:
-        bot.reply_to(message, "Чё рисовать-то? Скажи что хочешь — котика там или ещё что... всё сказал?")
-        return
-    
-    description = command_parts[1].strip()
-    if not description:
-        bot.reply_to(message, "Ну и что рисовать? Пустоту? Я не Малевич... дай тему нормальную.")
+    description, refusal = parse_image_description(message.text)
+    if refusal:
+        bot.reply_to(message, refusal)
         return
     
     # Показываем, что бот работает
@@ -568,35 +2215,104 @@ def generate_image(message):
         logger.error(f"Ошибка генерации изображения: {e}")
         bot.reply_to(message, "Сломалась моя кисточка... попробуй попозже, да уж.")
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    """Обработчик всех сообщений"""
-    user_id = message.from_user.id
-    user_message = message.text or ""
+class StreamThrottle:
+    """Решает, когда отправлять и править сообщение потокового ответа.
     
-    # Безопасное логирование
-    safe_log_message(user_id, user_message)
+    Первый непустой текст отправляется сразу, дальше правки не чаще одной
+    в interval секунд (лимиты Telegram на edit_message_text); финальный текст
+    применяется всегда, если он отличается от показанного.
+    """
     
-    # Сохраняем сообщение в базу данных
-    if DATABASE_INTEGRATION_ENABLED:
+    def __init__(self, interval=STREAM_EDIT_INTERVAL):
+        self.interval = interval
+        self.shown = None
+        self._last_edit = 0.0
+    
+    def next_action(self, text, final=False):
+        """"send", "edit" или None"""
+        text = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+        if not text or text == self.shown:
+            return None
+        if self.shown is None:
+            return "send"
+        if final or time.monotonic() - self._last_edit >= self.interval:
+            return "edit"
+        return None
+    
+    def mark_shown(self, text):
+        self.shown = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+        self._last_edit = time.monotonic()
+
+class StreamingReply:
+    """Ответ на сообщение, который появляется по мере генерации"""
+    
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self._throttle = StreamThrottle()
+    
+    def update(self, text, final=False):
+        action = self._throttle.next_action(text, final)
+        if action is None:
+            return
+        shown = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
         try:
-            save_user_message_to_db(message)
+            if action == "send":
+                self.sent = bot.reply_to(self.message, shown)
+            else:
+                edited = bot.edit_message_text(shown, self.sent.chat.id, self.sent.message_id)
+                if isinstance(edited, telebot.types.Message):
+                    self.sent = edited
+            self._throttle.mark_shown(shown)
         except Exception as e:
-            logger.warning(f"Failed to save user message to DB: {e}")
+            # Частичная правка не критична (например, "message is not modified")
+            if final or action == "send":
+                raise
+            logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+    
+    def finish(self, text):
+        """Показать финальный текст; возвращает отправленное сообщение бота"""
+        self.update(text, final=True)
+        if self.sent is None:
+            self.sent = bot.reply_to(self.message, text)
+        return self.sent
+
+def reply_to_turn(messages):
+    """Ответить на ход пользователя — одно сообщение или несколько, склеенных окном"""
+    message = messages[-1]
+    user_id = message.from_user.id
+    
+    for incoming in messages:
+        # Безопасное логирование
+        safe_log_message(user_id, incoming.text or "")
+        
+        # Сохраняем сообщение в базу данных
+        if DATABASE_INTEGRATION_ENABLED:
+            try:
+                save_user_message_to_db(incoming)
+            except Exception as e:
+                logger.warning(f"Failed to save user message to DB: {e}")
     
     # Показываем, что бот печатает
     bot.send_chat_action(message.chat.id, 'typing')
     
     # Получаем ответ от Кирилла с учетом настроек чата
-    response = kirill.get_response(user_id, user_message, message.chat.id)
+    streaming_reply = StreamingReply(message) if STREAM_REPLIES else None
+    response = kirill.get_response(
+        user_id, [incoming.text or "" for incoming in messages], message.chat.id,
+        on_partial=streaming_reply.update if streaming_reply else None
+    )
     
     # Логируем ответ с ограничением длины
     response_hash = hashlib.sha256(response.encode()).hexdigest()[:8]
-    logger.info(f"Кирилл ответил hash={response_hash} len={len(response)}")
+    logger.info(f"Кирилл ответил hash={response_hash} len={len(response)} merged={len(messages)}")
     
-    # Отправляем ответ
+    # Отправляем ответ на последнее сообщение хода (потоковый — дописываем финальный текст)
     try:
-        bot_response = bot.reply_to(message, response)
+        if streaming_reply:
+            bot_response = streaming_reply.finish(response)
+        else:
+            bot_response = bot.reply_to(message, response)
         
         # Сохраняем ответ бота в базу данных
         if DATABASE_INTEGRATION_ENABLED:
@@ -612,10 +2328,274 @@ def handle_message(message):
         except:
             pass
 
+def dispatch_turn(key, messages):
+    """Передать закрытый ход на обработку (вызывается потоком TurnDebouncer)"""
+    chat_id = messages[-1].chat.id
+    if lane_dispatcher is None:
+        # Без полос не занимаем поток планировщика ожиданием модели
+        threading.Thread(target=reply_to_turn, args=(messages,), daemon=True).start()
+    else:
+        lane_dispatcher.submit(chat_id, reply_to_turn, messages)
+
+turn_debouncer = TurnDebouncer(DEBOUNCE_WINDOW, dispatch_turn) if DEBOUNCE_WINDOW > 0 else None
+
+@bot.message_handler(func=lambda message: True)
+def handle_message(message):
+    """Обработчик всех сообщений"""
+    if turn_debouncer is not None:
+        # Ключ (чат, пользователь): ответ уходит туда же, откуда пришла серия
+        turn_debouncer.add((message.chat.id, message.from_user.id), message)
+        return
+    run_in_chat_lane(message.chat.id, reply_to_turn, [message])
+
+def build_async_bot():
+    """Собрать AsyncTeleBot с теми же обработчиками, что и у синхронного бота.
+    
+    В этом режиме обработчики, запросы к Gemini (client.aio) и запросы к БД
+    выполняются на одном цикле событий, без пула потоков TeleBot.
+    """
+    from telebot.async_telebot import AsyncTeleBot
+    
+    async_bot = AsyncTeleBot(TELEGRAM_BOT_TOKEN)
+    
+    async def save_to_db(message, is_from_bot=False, message_hash=None):
+        if not DATABASE_INTEGRATION_ENABLED or not message:
+            return
+        if WRITE_BEHIND_ENABLED:
+            # Постановка в очередь не блокирует цикл
+            message_writer.enqueue(message_to_row(message, is_from_bot=is_from_bot, message_hash=message_hash))
+            return
+        try:
+            await bot_db.ingest_update(message, is_from_bot=is_from_bot, message_hash=message_hash)
+        except Exception as e:
+            logger.error(f"Error saving message to database: {e}")
+    
+    @async_bot.message_handler(commands=['start'])
+    async def start_message_async(message):
+        await async_bot.reply_to(message, WELCOME_TEXT)
+    
+    @async_bot.message_handler(commands=['help'])
+    async def help_message_async(message):
+        await async_bot.reply_to(message, HELP_TEXT)
+    
+    @async_bot.message_handler(commands=['clear'])
+    async def clear_history_async(message):
+        chat_settings, _ = await get_chat_config_async(message.chat.id)
+        clear_conversation(conversation_key(message.from_user.id, message.chat.id, chat_settings))
+        await save_to_db(message)
+        await async_bot.reply_to(message, CLEAR_TEXT)
+    
+    @async_bot.message_handler(commands=['картинка', 'image', 'img'])
+    async def generate_image_async(message):
+        user_id = message.from_user.id
+        
+        if is_rate_limited(user_id):
+            await async_bot.reply_to(message, "Эй, не спеши так — дай мне подумать... ну ты понял.")
+            return
+        
+        description, refusal = parse_image_description(message.text)
+        if refusal:
+            await async_bot.reply_to(message, refusal)
+            return
+        
+        await async_bot.send_chat_action(message.chat.id, 'upload_photo')
+        
+        try:
+            image_response = await kirill.generate_image_async(user_id, description)
+            
+            if image_response and image_response.get('image'):
+                image_file = BytesIO(image_response['image'])
+                image_file.name = 'kirill_art.jpg'
+                await async_bot.send_photo(message.chat.id, image_file, caption=image_response['comment'])
+            elif image_response and image_response.get('comment'):
+                await async_bot.reply_to(message, image_response['comment'])
+            else:
+                await async_bot.reply_to(message, "Что-то не могу нарисовать... может, в другой раз — ну ты понял.")
+        
+        except Exception as e:
+            logger.error(f"Ошибка генерации изображения: {e}")
+            await async_bot.reply_to(message, "Сломалась моя кисточка... попробуй попозже, да уж.")
+    
+    class AsyncStreamingReply:
+        """StreamingReply для AsyncTeleBot"""
+        
+        def __init__(self, message):
+            self.message = message
+            self.sent = None
+            self._throttle = StreamThrottle()
+        
+        async def update(self, text, final=False):
+            action = self._throttle.next_action(text, final)
+            if action is None:
+                return
+            shown = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+            try:
+                if action == "send":
+                    self.sent = await async_bot.reply_to(self.message, shown)
+                else:
+                    edited = await async_bot.edit_message_text(shown, self.sent.chat.id, self.sent.message_id)
+                    if isinstance(edited, telebot.types.Message):
+                        self.sent = edited
+                self._throttle.mark_shown(shown)
+            except Exception as e:
+                if final or action == "send":
+                    raise
+                logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+        
+        async def finish(self, text):
+            await self.update(text, final=True)
+            if self.sent is None:
+                self.sent = await async_bot.reply_to(self.message, text)
+            return self.sent
+    
+    async def reply_to_turn_async(messages):
+        message = messages[-1]
+        user_id = message.from_user.id
+        
+        for incoming in messages:
+            safe_log_message(user_id, incoming.text or "")
+            await save_to_db(incoming)
+        await async_bot.send_chat_action(message.chat.id, 'typing')
+        
+        streaming_reply = AsyncStreamingReply(message) if STREAM_REPLIES else None
+        response = await kirill.get_response_async(
+            user_id, [incoming.text or "" for incoming in messages], message.chat.id,
+            on_partial=streaming_reply.update if streaming_reply else None
+        )
+        
+        response_hash = hashlib.sha256(response.encode()).hexdigest()[:8]
+        logger.info(f"Кирилл ответил hash={response_hash} len={len(response)} merged={len(messages)}")
+        
+        try:
+            if streaming_reply:
+                bot_response = await streaming_reply.finish(response)
+            else:
+                bot_response = await async_bot.reply_to(message, response)
+            await save_to_db(bot_response, is_from_bot=True, message_hash=response_hash)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения: {e}")
+            try:
+                await async_bot.reply_to(message, "Что-то у меня с интернетом... попробуй ещё раз.")
+            except Exception:
+                pass
+    
+    # Открытые ходы склейки: всё выполняется на одном цикле, поэтому блокировки не нужны
+    pending_turns = {}
+    
+    @async_bot.message_handler(func=lambda message: True)
+    async def handle_message_async(message):
+        if DEBOUNCE_WINDOW <= 0:
+            await reply_to_turn_async([message])
+            return
+        
+        key = (message.chat.id, message.from_user.id)
+        if key in pending_turns:
+            pending_turns[key].append(message)
+            return
+        
+        pending_turns[key] = [message]
+        try:
+            await asyncio.sleep(DEBOUNCE_WINDOW)
+        finally:
+            messages = pending_turns.pop(key)
+        await reply_to_turn_async(messages)
+    
+    return async_bot
+
+config_events = None
+
+def start_config_events():
+    """Подписаться на изменения конфигов из админки (Redis pub/sub, без Redis — опрос БД по updated_at)"""
+    global config_events
+    if not (DATABASE_INTEGRATION_ENABLED and CONFIG_EVENTS_ENABLED):
+        return
+    config_events = ConfigEventSubscriber(
+        invalidate_chat_configs,
+        lambda since: run_async(bot_db.get_config_changes(since))
+    )
+    config_events.start()
+
+async def run_asyncio_bot():
+    """Точка входа asyncio-режима"""
+    if DATABASE_INTEGRATION_ENABLED:
+        # Цикл бота становится циклом БД: соединения пула живут там же, где их используют
+        db_loop.adopt(asyncio.get_running_loop())
+    # Подписчик ходит в БД через цикл БД, поэтому запускается только после adopt
+    start_config_events()
+    try:
+        await build_async_bot().infinity_polling()
+    finally:
+        if DATABASE_INTEGRATION_ENABLED:
+            # asyncio.run закроет этот цикл: дописываем очередь и закрываем соединения,
+            # пока он работает (в потоках — запись сама идет через этот же цикл)
+            if config_events is not None:
+                await asyncio.to_thread(config_events.stop)
+            await asyncio.to_thread(message_writer.stop)
+            await db_loop.release()
+
+def run_webhook_bot():
+    """Точка входа режима вебхука: HTTP-приемник обновлений вместо long polling"""
+    import uvicorn
+    from fastapi import FastAPI
+    from app.webhook import create_webhook_router, TELEGRAM_WEBHOOK_SECRET, TELEGRAM_WEBHOOK_PATH
+    
+    def process_updates(updates):
+        # С полосами это только постановка в очереди, иначе — пул потоков TeleBot
+        bot.process_new_updates([telebot.types.Update.de_json(update) for update in updates])
+    
+    webhook_app = FastAPI(title="Kirill GPT Webhook")
+    webhook_app.include_router(create_webhook_router(process_updates))
+    
+    # Регистрирует вебхук только один экземпляр; остальные воркеры просто принимают обновления
+    webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+    if webhook_url:
+        bot.remove_webhook()
+        bot.set_webhook(url=webhook_url.rstrip("/") + TELEGRAM_WEBHOOK_PATH, secret_token=TELEGRAM_WEBHOOK_SECRET)
+        logger.info("Webhook registered")
+    
+    try:
+        uvicorn.run(
+            webhook_app,
+            host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443"))
+        )
+    finally:
+        if lane_dispatcher is not None:
+            lane_dispatcher.stop()
+
+# Режим выполнения: "threads" — TeleBot с пулом потоков, "asyncio" — AsyncTeleBot на одном цикле событий,
+# "webhook" — те же обработчики, что и в threads, но обновления приходят HTTP-запросами
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "threads").lower()
+
 if __name__ == "__main__":
-    logger.info("Кирилл GPT запускается...")
+    logger.info(f"Кирилл GPT запускается... runtime={BOT_RUNTIME}")
+    if state_snapshots is not None:
+        state_snapshots.load()
+        state_snapshots.start()
+    if stats_reporter is not None:
+        stats_reporter.start()
+    if BOT_RUNTIME != "asyncio":
+        start_config_events()
+    # systemd останавливает сервис по SIGTERM — завершаемся штатно, чтобы сохранить снимок
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         # Запускаем бота
-        bot.polling(none_stop=True)
+        if BOT_RUNTIME == "asyncio":
+            asyncio.run(run_asyncio_bot())
+        elif BOT_RUNTIME == "webhook":
+            run_webhook_bot()
+        else:
+            try:
+                bot.polling(none_stop=True)
+            finally:
+                if lane_dispatcher is not None:
+                    lane_dispatcher.stop()
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
\ No newline at end of file
+        logger.error(f"Ошибка при запуске бота: {e}")
+    finally:
+        if config_events is not None:
+            config_events.stop()
+        if stats_reporter is not None:
+            stats_reporter.stop()
+        if state_snapshots is not None:
+            state_snapshots.stop()
@@ -9,7 +9,7 @@ import os
 # Добавляем путь к модулю админки
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'admin', 'backend'))
 
-from app.database import async_engine, Base
+from app.database import async_engine, Base, add_missing_columns
 from app.models import Chat, User, Message, Preset, ChatSettings, AdminAction
 import logging
 
@@ -24,6 +24,8 @@ async def init_database():
         async with async_engine.begin() as conn:
             # Создаем все таблицы
             await conn.run_sync(Base.metadata.create_all)
+            # Добавляем новые колонки в таблицы, созданные старой версией
+            await conn.run_sync(add_missing_columns)
         
         logger.info("✅ Таблицы успешно созданы!")
         logger.info("Созданные таблицы:")